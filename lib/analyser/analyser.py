@@ -1,17 +1,30 @@
 import asyncio
 import logging
+import time
 
+from contextlib import contextmanager
+
+import numpy as np
 import pandas as pd
 
 # from analyserwrapper import *
 from lib.analyser.model.autoregressionmodel import AutoRegressionModel
 from lib.analyser.model.movingaveragemodel import MovingAverageModel
-from lib.analyser.model.prophetmodel import ProphetModel
+from lib.analyser.model.prophetmodel import ProphetModel, setup_prophet
 from lib.analyser.model.ffemodel import FastFourierExtrapolationModel
+from lib.analyser.model.batchffemodel import BatchFastFourierExtrapolationModel
 from lib.analyser.baseanalysis import basic_series_analysis
-from lib.siridb.siridb import SiriDB
+from lib.analyser.staticrules import rules_tail, rules_history, check_static_rules
+from lib.analyser.model.base import setup_incremental
+from lib.analyser.model.cache import setup_model_cache
+from lib.analyser.resolution import setup_resolution, get_point_budget, fetch_points_within_budget
+from lib.analyser.profiling import JobProfile, profile_job, setup_profiling
+from lib.analyser.cancellation import set_cancel_event, check_cancelled
+from lib.exceptions.analyserexception import JobCancelledException
 
 from enodo.jobs import JOB_TYPE_FORECAST_SERIES, JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, JOB_TYPE_BASE_SERIES_ANALYSIS, JOB_TYPE_STATIC_RULES
+from lib.jobs import JOB_TYPE_FORECAST_SERIES_BATCH, JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES_BATCH, BATCH_JOB_TYPES, \
+    JOB_TYPE_STATIC_RULES_BATCH
 
 
 
@@ -21,142 +34,367 @@ class Analyser:
     _siridb_client = None
     _shutdown = None
     _current_future = None
+    _job_id = None
+    _profile = None
+    _cancelled = None
 
-    def __init__(self, queue, siridb_user, siridb_password, siridb_db, siridb_host, siridb_port):
-        self._siridb_client = SiriDB(siridb_user, siridb_password, siridb_db, siridb_host, siridb_port)
+    def __init__(self, queue, siridb_client, cancelled=None):
+        """
+        :param queue: queue the results are put on
+        :param siridb_client: SiriDB connection
+        :param cancelled: threading.Event which cancels the job at its next checkpoint
+        """
+        self._siridb_client = siridb_client
         self._analyser_queue = queue
+        self._cancelled = cancelled
+
+    def _put_result(self, result):
+        if self._cancelled is not None and self._cancelled.is_set():
+            return
+        result['job_id'] = self._job_id
+        if self._profile is not None:
+            result['profile'] = self._profile.to_dict()
+        self._analyser_queue.put_threadsafe(result)
 
     async def execute_job(self, job_data):
+        self._job_id = job_data.get("job_id")
+        self._profile = JobProfile()
+        set_cancel_event(self._cancelled)
+        try:
+            with profile_job(self._profile, self._job_id, job_data.get("job_type")):
+                await self._execute_job(job_data)
+        finally:
+            set_cancel_event(None)
+
+    @contextmanager
+    def _stage(self, name):
+        """Profiled stage of a job, a cancelled job stops before the stage starts"""
+        check_cancelled()
+        with self._profile.stage(name):
+            yield
+
+    async def _execute_job(self, job_data):
         series_name = job_data.get("series_name")
         job_type = job_data.get("job_type")
-        series_data = await self._siridb_client.query_series_data(series_name)
-        dataset = pd.DataFrame(series_data[series_name])
+        if job_type in BATCH_JOB_TYPES:
+            await self._execute_batch_job(series_name, job_type, job_data)
+            return
+        if job_type == JOB_TYPE_STATIC_RULES:
+            parameters = job_data.get('series_config').get(JOB_TYPE_BASE_SERIES_ANALYSIS).get('model_params').get('static_rules')
+            await self._check_static_rules(series_name, parameters)
+            return
+        if job_type == JOB_TYPE_STATIC_RULES_BATCH:
+            await self._check_static_rules_batch(series_name, job_data)
+            return
 
         if job_type == JOB_TYPE_BASE_SERIES_ANALYSIS:
-            await self._analyse_series(series_name, dataset)
-        elif job_type == JOB_TYPE_STATIC_RULES:
-            parameters = job_data.get('series_config').get(JOB_TYPE_BASE_SERIES_ANALYSIS).get('model_params').get('static_rules')
-            await self._check_static_rules(series_name, dataset, parameters)
-        else:
-            job_config = job_data.get('series_config').get('job_config').get(job_type)
-            model = job_config.get('model')
-            parameters = job_config.get('model_params')
-            try:
+            with self._stage('fetch'):
+                series_points = await self._siridb_client.query_series_points(series_name)
+            if series_points is None:
+                raise Exception(f'Unable to fetch data of series "{series_name}"')
+            await self._analyse_series(series_name, *series_points)
+            return
+
+        job_config = job_data.get('series_config').get('job_config').get(job_type)
+        model = job_config.get('model')
+        parameters = job_config.get('model_params')
+        if job_type == JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES and (parameters or {}).get('incremental'):
+            if await self._detect_new_anomalies(series_name, model, parameters, job_data):
+                return
+        # Aggregate the series to the point budget of the model, which bounds the fit time
+        with self._stage('fetch'):
+            series_points = await fetch_points_within_budget(
+                self._siridb_client, series_name, get_point_budget(model, parameters))
+        if series_points is None:
+            raise Exception(f'Unable to fetch data of series "{series_name}"')
+        timestamps, values, resolution = series_points
+        self._profile.count_points('fetched', len(timestamps))
+        with self._stage('dataframe'):
+            dataset = pd.DataFrame({0: timestamps, 1: values})
+
+        try:
+            with self._stage('model_init'):
                 if model == 'prophet':
-                    analysis = ProphetModel(series_name, dataset, 100)
+                    analysis = ProphetModel(series_name, dataset, 100, resolution=resolution)
                 elif model =='ffe':
-                    analysis = FastFourierExtrapolationModel(series_name, series_data[series_name], parameters)
+                    analysis = FastFourierExtrapolationModel(series_name, dataset, parameters, resolution=resolution)
                 else:
                     raise Exception()
-            except Exception as e:
-                error = str(e)
-                self._analyser_queue.put({'name': series_name, 'error': error})
+        except Exception as e:
+            error = str(e)
+            self._put_result({'name': series_name, 'error': error})
+        else:
+            if job_type == JOB_TYPE_FORECAST_SERIES:
+                await self._forcast_series(series_name, analysis, job_data, resolution)
+            elif job_type == JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES:
+                await self._detect_anomalies(series_name, analysis, job_data, resolution)
             else:
-                if job_type == JOB_TYPE_FORECAST_SERIES:
-                    await self._forcast_series(series_name, analysis, job_data)
-                elif job_type == JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES:
-                    await self._detect_anomalies(series_name, analysis, job_data)
+                self._put_result({'name': series_name, 'error': 'Job type not implemented'})
+
+    async def _execute_batch_job(self, series_name, job_type, job_data):
+        """
+        Runs a job for many series at once, the series are listed in `series_names`
+        and share the job config. The result contains a result per series.
+        """
+        job_config = job_data.get('series_config').get('job_config').get(job_type)
+        parameters = job_config.get('model_params')
+        if job_config.get('model') != 'ffe':
+            self._put_result({'name': series_name, 'job_type': job_type, 'error': 'Unsupported model for batch job'})
+            return
+        since = parameters.get('points_since')
+        if job_type == JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES_BATCH and since is None:
+            self._put_result({'name': series_name, 'job_type': job_type,
+                              'error': 'Missing data `points_since` for anomaly detection'})
+            return
+
+        with self._stage('fetch'):
+            series_points = await self._siridb_client.query_multiple_series_points(job_data.get('series_names'))
+        if series_points is None:
+            raise Exception('Unable to fetch data of series')
+        self._profile.count_points('fetched', sum(len(timestamps) for timestamps, _ in series_points.values()))
+
+        error = None
+        results = {}
+        try:
+            with self._stage('batch_model'):
+                analysis = BatchFastFourierExtrapolationModel(series_points, parameters)
+                if job_type == JOB_TYPE_FORECAST_SERIES_BATCH:
+                    results = analysis.do_forecast()
                 else:
-                    self._analyser_queue.put({'name': series_name, 'error': 'Job type not implemented'})
+                    results = analysis.find_anomalies(since)
+        except Exception as e:
+            error = str(e)
+            logging.error('Error while executing batch model')
+            logging.debug(f'Correspondig error: {str(e)}')
+        finally:
+            if error is not None:
+                self._put_result({'name': series_name, 'job_type': job_type, 'error': error})
+            else:
+                self._put_result({'name': series_name, 'job_type': job_type, 'series': results})
 
-    async def _analyse_series(self, series_name, dataset):
-        points = dataset[0]
-        characteristics = await basic_series_analysis(points)
+    async def _analyse_series(self, series_name, timestamps, values):
+        self._profile.count_points('fetched', len(timestamps))
+        with self._stage('analysis'):
+            characteristics = await basic_series_analysis(series_name, timestamps, values)
 
-        self._analyser_queue.put(
+        self._put_result(
                     {'name': series_name, 'job_type': JOB_TYPE_BASE_SERIES_ANALYSIS, 'characteristics': characteristics})
 
-    async def _check_static_rules(self, series_name, dataset, static_rules):
-        min_value = static_rules.get('min')
-        max_value = static_rules.get('max')
-        last_n_points = int(static_rules.get('last_n_points'))
-
-        rows_to_check = dataset.tail(last_n_points)
-        failed_checks = {}
+    async def _fetch_static_rules_tail(self, series_name, static_rules):
+        """Fetch only the tail of a series the static rules need, with the
+        history the rate, gap and band checks look back on"""
+        window, last_n_points = rules_tail(static_rules)
+        history = rules_history(static_rules)
+        if window is not None:
+            series_points = await self._siridb_client.query_series_tail(series_name, window)
+            if series_points is None or not len(series_points[0]) or not history:
+                return series_points
+            history_points = await self._siridb_client.query_series_last_points(
+                series_name, history, before=series_points[0][0])
+            if history_points is None:
+                return None
+            return tuple(np.concatenate(arrays) for arrays in zip(history_points, series_points))
+        if last_n_points is not None and not self._siridb_client.is_cached(series_name):
+            return await self._siridb_client.query_series_last_points(series_name, last_n_points + history)
+        series_points = await self._siridb_client.query_series_points(series_name)
+        if series_points is None or last_n_points is None:
+            return series_points
+        timestamps, values = series_points
+        return timestamps[-(last_n_points + history):], values[-(last_n_points + history):]
 
-        if min_value is not None:
-            data_min = rows_to_check[1].min()
-            if data_min < min_value:
-                failed_checks['min'] = f"Found value lower than min value. ({data_min} < {min_value})"
-        if max_value is not None:
-            data_max = rows_to_check[1].max()
-            if data_max > max_value:
-                failed_checks['max'] = f"Found value higher than max value. ({data_max} > {max_value})"
+    async def _check_static_rules(self, series_name, static_rules):
+        with self._stage('fetch'):
+            series_points = await self._fetch_static_rules_tail(series_name, static_rules)
+        if series_points is None:
+            raise Exception(f'Unable to fetch data of series "{series_name}"')
+        self._profile.count_points('fetched', len(series_points[0]))
+        with self._stage('rules'):
+            failed_checks = check_static_rules(*series_points, static_rules)
 
-        self._analyser_queue.put(
+        self._put_result(
                 {'name': series_name, 'job_type': JOB_TYPE_STATIC_RULES, 'failed_checks': failed_checks})
 
-    async def _forcast_series(self, series_name, analysis_model, job_data):
+    async def _check_static_rules_batch(self, series_name, job_data):
+        """
+        Checks the static rules of many series at once, `series_rules` holds the rules per series.
+        Series with a rules window are fetched in one query, using `series_selector` (a regex or
+        group matching the series) when given. Of series checking their last points only the tail
+        is fetched, the result contains the failed checks per series.
+        """
+        series_rules = job_data.get('series_rules') or {}
+        windows = {}
+        tails = {}
+        for name, static_rules in series_rules.items():
+            window, last_n_points = rules_tail(static_rules)
+            if window is not None:
+                windows[name] = window
+            elif last_n_points is not None:
+                tails[name] = last_n_points + rules_history(static_rules)
+
+        series_points = {}
+        with self._stage('fetch'):
+            if windows:
+                series_points = await self._siridb_client.query_multiple_series_tail(
+                    list(windows), max(windows.values()), job_data.get('series_selector'))
+                if series_points is None:
+                    raise Exception('Unable to fetch data of series')
+            for name, num_points in tails.items():
+                if self._siridb_client.is_cached(name):
+                    continue
+                tail_points = await self._siridb_client.query_series_last_points(name, num_points)
+                if tail_points is None:
+                    raise Exception(f'Unable to fetch data of series "{name}"')
+                series_points[name] = tail_points
+            other_series = [name for name in series_rules if name not in windows and name not in series_points]
+            if other_series:
+                other_points = await self._siridb_client.query_multiple_series_points(other_series)
+                if other_points is None:
+                    raise Exception('Unable to fetch data of series')
+                # Cached series are extended in full, check only their tail
+                for name, (timestamps, values) in other_points.items():
+                    num_points = tails.get(name)
+                    series_points[name] = (timestamps, values) if num_points is None else \
+                        (timestamps[-num_points:], values[-num_points:])
+        self._profile.count_points('fetched', sum(len(timestamps) for timestamps, _ in series_points.values()))
+
+        now = time.time()
+        results = {}
+        with self._stage('rules'):
+            for name, static_rules in series_rules.items():
+                check_cancelled()
+                try:
+                    results[name] = {'failed_checks': check_static_rules(*series_points[name], static_rules, now)}
+                except Exception as e:
+                    results[name] = {'error': str(e)}
+        self._put_result({'name': series_name, 'job_type': JOB_TYPE_STATIC_RULES_BATCH, 'series': results})
+
+    async def _forcast_series(self, series_name, analysis_model, job_data, resolution=None):
         """
         Collects data for starting an analysis of a specific time serie
         :param series_name:
+        :param resolution: seconds the series is aggregated to, None for raw points
         :return:
         """
         error = None
         forecast_values = []
         try:
-            analysis_model.create_model()
-            forecast_values = analysis_model.do_forecast()
+            with self._stage('create_model'):
+                analysis_model.create_model()
+            with self._stage('do_forecast'):
+                forecast_values = analysis_model.do_forecast()
+            self._profile.count_points('result', len(forecast_values))
         except Exception as e:
             error = str(e)
             logging.error('Error while making and executing forcast model')
             logging.debug(f'Correspondig error: {str(e)}')
         finally:
             if error is not None:
-                self._analyser_queue.put({'name': series_name, 'job_type': JOB_TYPE_FORECAST_SERIES, 'error': error})
+                self._put_result({'name': series_name, 'job_type': JOB_TYPE_FORECAST_SERIES, 'error': error})
             else:
-                self._analyser_queue.put(
-                    {'name': series_name, 'job_type': JOB_TYPE_FORECAST_SERIES, 'points': forecast_values})
+                self._put_result(
+                    {'name': series_name, 'job_type': JOB_TYPE_FORECAST_SERIES, 'points': forecast_values,
+                     'resolution': resolution})
 
-    async def _detect_anomalies(self, series_name, analysis_model, job_data):
+    async def _detect_new_anomalies(self, series_name, model, parameters, job_data):
+        """
+        Scores only the points since `points_since` against the cached model of an earlier detection,
+        fetching only the points after the model or since `points_since`. Returns False when there is
+        no cached model or when it is too stale, the full series should be analysed then, which caches
+        the model again.
+        """
+        model_class = {'prophet': ProphetModel, 'ffe': FastFourierExtrapolationModel}.get(model)
+        since = job_data.get('series_config').get('model_params').get('points_since')
+        if model_class is None or since is None:
+            return False
+        cached = model_class.cached_anomaly_baseline(series_name, since)
+        if cached is None:
+            return False
+        with self._stage('fetch'):
+            # Fetch the points after the model as well, to tell how stale it is
+            series_points = await self._siridb_client.query_series_points_since(
+                series_name, min(since, cached.last_timestamp + 1))
+        if series_points is None:
+            raise Exception(f'Unable to fetch data of series "{series_name}"')
+        timestamps, values = series_points
+        self._profile.count_points('fetched', len(timestamps))
+        if model_class.baseline_is_stale(cached, timestamps, since):
+            logging.debug(f'Cached model of series "{series_name}" is stale, detecting anomalies in full')
+            return False
+        scored = timestamps >= since
+        timestamps, values = timestamps[scored], values[scored]
+
+        error = None
+        anomalies, resolution = [], cached.resolution
+        try:
+            with self._stage('find_new_anomalies'):
+                anomalies, resolution = model_class.find_new_anomalies(cached, timestamps, values, parameters)
+        except Exception as e:
+            error = str(e)
+            logging.error('Error while scoring new points for anomalies')
+            logging.debug(f'Correspondig error: {str(e)}')
+        if error is not None:
+            self._put_result({'name': series_name, 'job_type': JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, 'error': error})
+        else:
+            self._put_result(
+                {'name': series_name, 'job_type': JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, 'anomalies': anomalies,
+                 'resolution': resolution, 'incremental': True})
+        return True
+
+    async def _detect_anomalies(self, series_name, analysis_model, job_data, resolution=None):
         since = job_data.get('series_config').get('model_params').get('points_since')
         if since is None:
-            self._analyser_queue.put(
+            self._put_result(
                 {'name': series_name, 'job_type': JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES,
                  'error': 'Missing data `points_since` for anomaly detection'})
             return
         error = None
         anomalies_timestamps = []
         try:
-            analysis_model.create_model()
-            anomalies_timestamps = analysis_model.find_anomalies(since)
+            # Models fit what they need for anomaly detection themselves
+            with self._stage('find_anomalies'):
+                anomalies_timestamps = analysis_model.find_anomalies(since)
+            self._profile.count_points('result', len(anomalies_timestamps))
         except Exception as e:
             error = str(e)
             logging.error('Error while making and executing anomaly detection model')
             logging.debug(f'Correspondig error: {str(e)}')
         finally:
             if error is not None:
-                self._analyser_queue.put({'name': series_name, 'job_type': JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, 'error': error})
+                self._put_result({'name': series_name, 'job_type': JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, 'error': error})
             else:
-                self._analyser_queue.put(
-                    {'name': series_name, 'job_type': JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, 'anomalies': anomalies_timestamps})
+                self._put_result(
+                    {'name': series_name, 'job_type': JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, 'anomalies': anomalies_timestamps,
+                     'resolution': resolution})
+
+
+def setup_analyser(settings):
+    """Prepare the analyser for running jobs, done once per process"""
+    model_cache_settings = settings.get('model_cache')
+    if model_cache_settings:
+        setup_model_cache(**model_cache_settings)
+    prophet_settings = settings.get('prophet')
+    if prophet_settings:
+        setup_prophet(**prophet_settings)
+    resolution_settings = settings.get('resolution')
+    if resolution_settings:
+        setup_resolution(**resolution_settings)
+    incremental_settings = settings.get('incremental')
+    if incremental_settings:
+        setup_incremental(**incremental_settings)
+    profiling_settings = settings.get('profiling')
+    if profiling_settings:
+        setup_profiling(**profiling_settings)
 
 
-async def _save_start_with_timeout(loop, queue, job_data,
-                                   siridb_user, siridb_password,
-                                   siridb_dbname, siridb_host,
-                                   siridb_port):
+async def _save_start_with_timeout(loop, queue, job_data, siridb_client, cancelled=None):
     try:
         asyncio.set_event_loop(loop)
-        analyser = Analyser(queue, siridb_user, siridb_password, siridb_dbname, siridb_host,
-                            siridb_port)
+        analyser = Analyser(queue, siridb_client, cancelled)
         await analyser.execute_job(job_data)
+    except JobCancelledException:
+        logging.info(f'Job {job_data.get("job_id")} stopped after being cancelled')
     except Exception as e:
         logging.error('Error while executing Analyzer')
         logging.debug(f'Correspondig error: {str(e)}')
+        queue.put_threadsafe({'name': job_data.get("series_name"), 'job_id': job_data.get("job_id"), 'error': str(e)})
 
-
-def start_analysing(loop, queue, job_data,
-                    siridb_user, siridb_password,
-                    siridb_dbname, siridb_host, siridb_port):
-    """Switch to new event loop and run forever"""
-    asyncio.set_event_loop(loop)
-    try:
-        loop.run_until_complete(
-            _save_start_with_timeout(loop, queue, job_data,
-                                     siridb_user, siridb_password,
-                                     siridb_dbname, siridb_host,
-                                     siridb_port))
-        loop.stop()
-    except Exception as e:
-        exit()
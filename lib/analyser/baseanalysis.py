@@ -1,18 +1,98 @@
-
 import numpy as np
-import pandas as pd
 
-async def basic_series_analysis(data_points):
-    slope = await _get_series_slope(data_points)
+from lib.analyser.sampling import detect_sampling_interval
+from lib.analyser.stationarity import stationarity_test
+
+# Seasonality is searched in the most recent points only, which bounds the cost of the FFT
+MAX_SEASONALITY_POINTS = 8192
+# Minimum autocorrelation at the period for a series to be seasonal
+MIN_SEASONALITY_CORRELATION = .3
+# Intervals larger than this factor times the sampling interval are gaps
+GAP_FACTOR = 2
+
+
+async def basic_series_analysis(series_name, timestamps, values):
+    """
+    Characteristics of a series, computed in a few vectorized passes so the
+    hub can pick models without fitting them
+    :param series_name: name of the series
+    :param timestamps: numpy array with the timestamps of the series, in seconds
+    :param values: numpy array with the values of the series
+    :return: dict with the trend (slope per second), seasonality period in seconds, noise level,
+        sampling interval in seconds, regularity of the intervals, ratio of missing points and
+        the stationarity test. Characteristics which cannot be computed are None.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    interval, regularity = detect_sampling_interval(timestamps)
 
     return {
-        "trend": slope
+        "trend": _get_series_slope(timestamps, values),
+        "seasonality": _get_seasonality_period(timestamps, values, interval),
+        "noise": _get_noise_level(values),
+        "sampling_interval": interval,
+        "regularity": regularity,
+        "gap_ratio": _get_gap_ratio(timestamps, interval),
+        "stationarity": stationarity_test(series_name, timestamps, values)
     }
 
-async def _get_series_slope(data):
-    try:
-        coeffs = np.polyfit(data.index.values, list(data), 1)
-        slope = coeffs[-2]
-    except Exception as _:
+
+def _get_series_slope(timestamps, values):
+    """Least squares slope of the values over time"""
+    if len(values) < 2:
+        return None
+    t = (timestamps - timestamps[0]).astype(np.float64)
+    t -= t.mean()
+    denominator = np.dot(t, t)
+    if not denominator:
+        return None
+    return float(np.dot(t, values - values.mean()) / denominator)
+
+
+def _get_noise_level(values):
+    """Standard deviation of the noise, estimated from the differences between
+    succeeding values so trends and seasonality hardly affect it.
+    """
+    if len(values) < 3:
+        return None
+    return float(np.std(np.diff(values)) / np.sqrt(2))
+
+
+def _get_gap_ratio(timestamps, interval):
+    """Fraction of the expected points which are missing because of gaps"""
+    if interval is None:
+        return None
+    intervals = np.diff(timestamps)
+    gaps = intervals[intervals > GAP_FACTOR * interval]
+    missing = np.sum(np.round(gaps / interval) - 1)
+    return float(missing / (len(timestamps) + missing))
+
+
+def _get_seasonality_period(timestamps, values, interval):
+    """Seasonality period in seconds from the autocorrelation of the most
+    recent points, computed with an FFT on a regular grid. Returns None when
+    the series is not seasonal.
+    """
+    if interval is None:
+        return None
+    timestamps, values = timestamps[-MAX_SEASONALITY_POINTS:], values[-MAX_SEASONALITY_POINTS:]
+    grid = np.arange(timestamps[0], timestamps[-1] + 1, interval)
+    if len(grid) < 8:
+        return None
+    grid = grid[-MAX_SEASONALITY_POINTS:]
+    x = np.interp(grid, timestamps, values)
+    x -= np.polyval(np.polyfit(np.arange(len(x)), x, 1), np.arange(len(x)))
+    n = len(x)
+    spectrum = np.fft.rfft(x, 2 * n)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum))[:n // 2]
+    if acf[0] <= 0:
+        return None
+    acf /= acf[0]
+    # The period is the highest autocorrelation after it first drops below zero
+    negative = np.flatnonzero(acf < 0)
+    if not len(negative):
+        return None
+    lag = negative[0] + int(np.argmax(acf[negative[0]:]))
+    if acf[lag] < MIN_SEASONALITY_CORRELATION:
         return None
-    return float(slope)
\ No newline at end of file
+    return float(lag * interval)
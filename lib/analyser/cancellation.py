@@ -0,0 +1,21 @@
+import threading
+
+from lib.exceptions.analyserexception import JobCancelledException
+
+# The cancel event of the job running on the current thread
+_current = threading.local()
+
+
+def set_cancel_event(event):
+    """Set the event which cancels the job running on the current thread, None when no job runs"""
+    _current.event = event
+
+
+def check_cancelled():
+    """Checkpoint of a job, raises JobCancelledException when the job running
+    on this thread got cancelled. Place it between steps of a job which can
+    take long, the step running when a job is cancelled is finished first.
+    """
+    event = getattr(_current, 'event', None)
+    if event is not None and event.is_set():
+        raise JobCancelledException()
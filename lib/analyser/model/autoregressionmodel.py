@@ -1,16 +1,15 @@
-import datetime
-import time
-
 import pandas as pd
 import numpy as np
 from statsmodels.tsa.ar_model import AR
 
 from lib.analyser.model.base import Model
+from lib.analyser.model.serialization import datetime_to_epoch, to_points
+from lib.analyser.sampling import detect_sampling_interval
 
 
 class AutoRegressionModel(Model):
 
-    def __init__(self, series_name, dataset, freq='2H'):
+    def __init__(self, series_name, dataset, freq=None):
         """
         Start modelling a time serie
         :param series_name: name of the serie
@@ -18,10 +17,16 @@ class AutoRegressionModel(Model):
         :param m: the seasonality factor
         :param d: the de-rending differencing factor
         :param d_large: the de-seasonality differencing factor
+        :param freq: frequency to resample the series to, detected from the series when None
         """
         super().__init__(series_name, dataset)
         self._model = None
         self._dataset = dataset
+        if freq is None:
+            interval, _ = detect_sampling_interval(dataset[0].to_numpy())
+            if interval is None:
+                raise Exception('Not enough points to detect the frequency of the series')
+            freq = pd.Timedelta(seconds=max(round(interval), 1))
 
         self.forecast_values = None
         self.is_stationary = False
@@ -56,15 +61,7 @@ class AutoRegressionModel(Model):
         if update or self.forecast_values is None:
             yhat = self._model.predict(len(self._dataset), len(self._dataset) + 200)
             # yhat = self._model.predict(start=1, end=5)
-            indexed_forecast_values = []
-            # values = yhat.to_frame()
-            values = pd.DataFrame({'ds': yhat.index, 'yhat': yhat.values})
-            for index, row in values.iterrows():
-                indexed_forecast_values.append(
-                    [int(time.mktime(
-                        datetime.datetime.strptime(str(row['ds']), "%Y-%m-%d %H:%M:%S").timetuple())),
-                     row['yhat']])
-            self.forecast_values = indexed_forecast_values
+            self.forecast_values = to_points(datetime_to_epoch(yhat.index), yhat.values)
             return self.forecast_values
         else:
             return self.forecast_values
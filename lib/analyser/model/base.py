@@ -1,43 +1,63 @@
-from datetime import timedelta
+import pickle
 
-from statsmodels.tsa.stattools import adfuller
+import numpy as np
 import pandas as pd
 
+from lib.analyser.cancellation import check_cancelled
+from lib.analyser.model.cache import get_model_cache, model_cache_key
+from lib.analyser.sampling import detect_sampling_interval
+from lib.analyser.stationarity import stationarity_test
+
+# When the cached model of an incremental anomaly detection is too stale to
+# score new points against, see setup_incremental
+_incremental = {
+    'max_new_ratio': .1,
+    'max_age': 86400,
+}
+
+
+def setup_incremental(max_new_ratio, max_age):
+    """
+    Configure when incremental anomaly detection falls back to a full detection, which refits
+    and caches the model again
+    :param max_new_ratio: maximum number of points after the last point of the cached model, as a
+        ratio of the number of points it is fitted on
+    :param max_age: maximum number of seconds between the last point of the cached model and
+        `points_since`, 0 for no limit
+    """
+    _incremental['max_new_ratio'] = max_new_ratio
+    _incremental['max_age'] = max_age
+
 
 class Model:
-    def __init__(self, series_name, dataset, initialize=True):
+    def __init__(self, series_name, dataset, resolution=None):
         """
         Start modelling a time serie
         :param series_name: name of the serie
         :param dataset: dataframe (Panda) with datapoints
+        :param resolution: aggregation interval in seconds of the datapoints, None for raw points
         """
         self._series_name = series_name
         self._dataset = dataset
-
-        if initialize:
-            self._has_trend = self._adf_stationarity_test(self._dataset)
-
-    def _adf_stationarity_test(self, timeseries):
-
-        # Dickey-Fuller test:
-        adf_test = adfuller(timeseries[1], autolag='AIC')
-
-        p_value = adf_test[1]
-
-        return p_value >= .05
+        self._resolution = resolution
+        # Watermark of the data, used to find a reusable fitted model
+        self._last_timestamp = int(dataset[0].iloc[-1]) if len(dataset) else None
+        self._num_points = len(dataset)
+        # Subclasses reshape the dataset, keep the original columns for lazy tests
+        self._timestamps = dataset[0].to_numpy()
+        self._values = dataset[1].to_numpy()
+
+    @property
+    def has_trend(self):
+        """Whether the series is not stationary, tested lazily on a bounded window"""
+        result = stationarity_test(self._series_name, self._timestamps, self._values)
+        return None if result is None else not result['stationary']
 
     def _find_frequency(self, datetime_list):
-
-        summed_freq = timedelta(seconds=0)
-        summed_count = 0
-        i = 1
-        while i < len(datetime_list):
-            if (i - 1) in datetime_list and i in datetime_list:
-                summed_freq += abs(datetime_list[i - 1] - datetime_list[i])
-                summed_count += 1
-            i += 1
-
-        return summed_freq / (summed_count)
+        interval, _ = detect_sampling_interval(datetime_list)
+        if interval is None:
+            raise Exception('Not enough points to detect the frequency of the series')
+        return pd.Timedelta(interval, unit='ns')
 
     # ------------------------------------------------------------------------------
     # accept a dataframe, remove outliers, return cleaned data in a new dataframe
@@ -52,6 +72,108 @@ class Model:
         df_out = df_in.loc[(df_in[col_name] > fence_low) & (df_in[col_name] < fence_high)]
         return df_out
 
+    def _fit_cached(self, model_name, fit, params=None, max_warm_refits=0, warm_start_ratio=0):
+        """
+        Returns a fitted model from the model cache, or calls fit and caches its result
+        :param model_name: name of the fitted model, unique per model class
+        :param fit: function returning a fitted model, gets the previously fitted model to warm start
+            from or None for a full fit
+        :param params: params the fitted model depends on
+        :param max_warm_refits: number of warm started fits before a full fit is forced
+        :param warm_start_ratio: warm start when the series got at most this ratio of points extra
+        """
+        check_cancelled()
+        model_cache = get_model_cache()
+        if model_cache is None or self._last_timestamp is None:
+            return fit(None)
+        key = model_cache_key(self._series_name, f'{self.__class__.__name__}.{model_name}', params)
+        model = model_cache.get(key, self._last_timestamp, self._num_points, self._resolution)
+        if model is not None:
+            return model
+
+        previous = model_cache.get_previous(key) if max_warm_refits else None
+        if previous is not None and previous.warm_refits < max_warm_refits and \
+                previous.resolution == self._resolution and \
+                previous.last_timestamp <= self._last_timestamp and \
+                0 < self._num_points - previous.num_points <= warm_start_ratio * previous.num_points:
+            model = fit(previous.model)
+            warm_refits = previous.warm_refits + 1
+        else:
+            model = fit(None)
+            warm_refits = 0
+        model_cache.put(key, model, self._last_timestamp, self._num_points, warm_refits, self._resolution)
+        return model
+
+    def _cache_baseline(self, model_name, model, params=None):
+        """Caches a fitted model for scoring new points only, the model is
+        never returned by _fit_cached.
+        """
+        model_cache = get_model_cache()
+        if model_cache is None or self._last_timestamp is None:
+            return
+        key = model_cache_key(self._series_name, f'{self.__class__.__name__}.{model_name}', params)
+        model_cache.put(key, model, self._last_timestamp, self._num_points, resolution=self._resolution)
+
+    @classmethod
+    def _cached_baseline(cls, series_name, model_name, params=None):
+        """Returns the last cached entry of a fitted model of a series, with
+        its watermark and resolution, or None when there is none.
+        """
+        model_cache = get_model_cache()
+        if model_cache is None:
+            return None
+        return model_cache.get_previous(model_cache_key(series_name, f'{cls.__name__}.{model_name}', params))
+
+    @classmethod
+    def cached_anomaly_baseline(cls, series_name, since):
+        """
+        Returns the cached model of the last full anomaly detection of a series
+        :param series_name: name of the series
+        :param since: timestamp of the first point to score
+        :return: cached entry with the model, watermark and resolution, or None when there is none
+            or when its last point is more than the max age before since
+        """
+        cached = cls._cached_baseline(series_name, 'anomaly')
+        if cached is None:
+            return None
+        max_age = _incremental['max_age']
+        if max_age and since - cached.last_timestamp > max_age:
+            return None
+        return cached
+
+    @staticmethod
+    def baseline_is_stale(cached, timestamps, since):
+        """
+        Whether the points fetched since the watermark of a cached model are too many to score
+        against it
+        :param cached: cached entry returned by cached_anomaly_baseline
+        :param timestamps: numpy array with the timestamps of the points after the watermark of the
+            cached model or since, whichever is earlier
+        :param since: timestamp of the first point to score
+        :return: True when the points after the watermark exceed the max ratio of the fitted points,
+            or when there are more points to score than fitted points, counted at the resolution of
+            the cached model
+        """
+        new = timestamps[timestamps > cached.last_timestamp]
+        scored = timestamps[timestamps >= since]
+        if cached.resolution is not None:
+            new = np.unique(-(-new // cached.resolution))
+            scored = np.unique(-(-scored // cached.resolution))
+        return len(new) > _incremental['max_new_ratio'] * cached.num_points or len(scored) > cached.num_points
+
+    @classmethod
+    def find_new_anomalies(cls, cached, timestamps, values, model_params):
+        """
+        Score only new points against the cached model of an earlier anomaly detection
+        :param cached: cached entry returned by cached_anomaly_baseline
+        :param timestamps: numpy array with the timestamps of the new points
+        :param values: numpy array with the values of the new points
+        :param model_params: model params of the job
+        :return: tuple with the anomalies and the resolution in seconds they are aggregated to (None
+            for raw points)
+        """
+        return [], cached.resolution
+
     def create_model(self):
         pass
 
@@ -62,8 +184,10 @@ class Model:
         pass
 
     def pickle(self):
-        pass
+        return pickle.dumps(self._model)
 
     @classmethod
     def unload(cls, series_name):
-        pass
+        model_cache = get_model_cache()
+        if model_cache is not None:
+            model_cache.remove_series(series_name)
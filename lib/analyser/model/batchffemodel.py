@@ -0,0 +1,73 @@
+from collections import defaultdict
+
+import numpy as np
+
+from lib.analyser.cancellation import check_cancelled
+from lib.analyser.model.ffemodel import remove_outliers, batch_fourier_extrapolation, forecast_timestamps, \
+    find_anomaly_mask
+from lib.analyser.model.serialization import to_points
+
+# Maximum number of series computed in one pass, bounds the memory used
+MAX_BATCH_SIZE = 256
+
+
+class BatchFastFourierExtrapolationModel:
+
+    def __init__(self, series, model_params):
+        """
+        Start modelling many time series at once with the FFE model
+        :param series: dict with per series name a tuple with timestamps and values (numpy arrays)
+        :param model_params: FFE model params, with optionally `bucket_size`. When larger than one the
+            oldest points of a series are dropped until its length is a multiple of the bucket size,
+            so series of about the same length are computed together.
+        """
+        self._series = series
+        self._model_params = model_params
+        self._bucket_size = int(model_params.get('bucket_size', 1))
+
+    def _bucket_by_length(self, series):
+        buckets = defaultdict(list)
+        errors = {}
+        for series_name, (timestamps, values) in series.items():
+            n = len(values)
+            if n < 2:
+                errors[series_name] = {'error': 'Not enough points for FFE model'}
+                continue
+            if self._bucket_size > 1 and n >= self._bucket_size:
+                n -= n % self._bucket_size
+            buckets[n].append((series_name, timestamps[-n:], values[-n:]))
+        batches = []
+        for bucket in buckets.values():
+            for i in range(0, len(bucket), MAX_BATCH_SIZE):
+                batches.append(bucket[i:i + MAX_BATCH_SIZE])
+        return batches, errors
+
+    def do_forecast(self):
+        n_predict = self._model_params.get('n_predict', 100)
+        trimmed = {series_name: remove_outliers(timestamps, values) if len(values) else (timestamps, values)
+                   for series_name, (timestamps, values) in self._series.items()}
+        batches, results = self._bucket_by_length(trimmed)
+
+        for bucket in batches:
+            check_cancelled()
+            fe_values = batch_fourier_extrapolation(
+                np.stack([values for _, _, values in bucket]), n_predict, is_forecast=True)
+            for (series_name, timestamps, _), series_fe_values in zip(bucket, fe_values):
+                fe_timestamps = forecast_timestamps(timestamps, n_predict)
+                results[series_name] = {'points': to_points(fe_timestamps, series_fe_values)}
+        return results
+
+    def find_anomalies(self, points_since):
+        sensitivity = self._model_params.get('anomaly_detection_sensitivity', 2)
+        batches, results = self._bucket_by_length(self._series)
+
+        for bucket in batches:
+            check_cancelled()
+            timestamps = np.stack([timestamps for _, timestamps, _ in bucket])
+            values = np.stack([values for _, _, values in bucket])
+            fe_values = batch_fourier_extrapolation(values, 0, is_forecast=False)
+            anomalies = find_anomaly_mask(values, fe_values, sensitivity)
+            anomalies &= timestamps >= points_since
+            for i, (series_name, _, _) in enumerate(bucket):
+                results[series_name] = {'anomalies': to_points(timestamps[i][anomalies[i]], values[i][anomalies[i]])}
+        return results
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+
+from collections import OrderedDict
+
+_model_cache = None
+
+
+def setup_model_cache(max_models, reuse_ratio, path=None):
+    global _model_cache
+    _model_cache = ModelCache(max_models, reuse_ratio, path) if max_models else None
+
+
+def get_model_cache():
+    return _model_cache
+
+
+def model_cache_key(series_name, model_name, params=None):
+    return series_name, model_name, json.dumps(params or {}, sort_keys=True, default=str)
+
+
+class CachedModel:
+
+    __slots__ = ('model', 'last_timestamp', 'num_points', 'warm_refits', 'resolution')
+
+    def __init__(self, model, last_timestamp, num_points, warm_refits=0, resolution=None):
+        self.model = model
+        self.last_timestamp = last_timestamp
+        self.num_points = num_points
+        self.warm_refits = warm_refits
+        # Aggregation interval of the points the model is fitted on, None for raw points
+        self.resolution = resolution
+
+
+class ModelCache:
+    """Cache with fitted models, keyed by series name, model and params
+
+    A fitted model is reused when the data watermark (last timestamp and
+    number of points) is unchanged, or when the series got at most
+    reuse_ratio times the number of fitted points extra, and only for points
+    aggregated to the same resolution. Least recently
+    used models are evicted when more than max_models are cached. With a path
+    the models are pickled to disk as well, so they survive a restart.
+    """
+
+    def __init__(self, max_models, reuse_ratio, path=None):
+        self._max_models = max_models
+        self._reuse_ratio = reuse_ratio
+        self._path = path
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def _file_path(self, key):
+        return os.path.join(
+            self._path, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pkl')
+
+    def _load(self, key):
+        try:
+            with open(self._file_path(key), 'rb') as fh:
+                stored_key, cached = pickle.load(fh)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.debug(f'Unable to load cached model: {str(e)}')
+            return None
+        return cached if stored_key == key else None
+
+    def _is_usable(self, cached, last_timestamp, num_points, resolution):
+        if resolution != cached.resolution:
+            return False
+        if last_timestamp < cached.last_timestamp or num_points < cached.num_points:
+            return False
+        return num_points - cached.num_points <= self._reuse_ratio * cached.num_points
+
+    def _get(self, key):
+        cached = self._models.get(key)
+        if cached is None and self._path:
+            cached = self._load(key)
+            if cached is not None:
+                self._add(key, cached)
+        if cached is not None:
+            self._models.move_to_end(key)
+        return cached
+
+    def get(self, key, last_timestamp, num_points, resolution=None):
+        with self._lock:
+            cached = self._get(key)
+            if cached is None or not self._is_usable(cached, last_timestamp, num_points, resolution):
+                return None
+            return cached.model
+
+    def get_previous(self, key):
+        """Returns the last cached model for a key, regardless its watermark"""
+        with self._lock:
+            return self._get(key)
+
+    def put(self, key, model, last_timestamp, num_points, warm_refits=0, resolution=None):
+        cached = CachedModel(model, last_timestamp, num_points, warm_refits, resolution)
+        with self._lock:
+            self._models.pop(key, None)
+            self._add(key, cached)
+        if self._path:
+            try:
+                tmp_path = self._file_path(key) + '.tmp'
+                with open(tmp_path, 'wb') as fh:
+                    pickle.dump((key, cached), fh)
+                os.replace(tmp_path, self._file_path(key))
+            except Exception as e:
+                logging.error('Error while storing fitted model')
+                logging.debug(f'Correspondig error: {str(e)}')
+
+    def remove_series(self, series_name):
+        with self._lock:
+            for key in [key for key in self._models if key[0] == series_name]:
+                self._remove(key)
+
+    def _add(self, key, cached):
+        self._models[key] = cached
+        while len(self._models) > self._max_models:
+            self._remove(next(iter(self._models)))
+
+    def _remove(self, key):
+        self._models.pop(key, None)
+        if self._path:
+            try:
+                os.remove(self._file_path(key))
+            except FileNotFoundError:
+                pass
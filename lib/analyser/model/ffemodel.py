@@ -1,24 +1,147 @@
-import datetime
-import time
-import pandas as pd
-
 import numpy as np
 from numpy import fft
 from lib.analyser.model.base import Model
+from lib.analyser.model.serialization import to_points
+from lib.analyser.resolution import downsample
+from lib.analyser.sampling import detect_sampling_interval
+
+N_HARMONICS = 10  # number of harmonics in model
+
+
+def remove_outliers(timestamps, values, lower=.10, upper=.90):
+    """Keep the points with a value between the lower and upper quantile"""
+    low, high = np.quantile(values, [lower, upper])
+    keep = (values >= low) & (values <= high)
+    return timestamps[keep], values[keep]
+
+
+def fourier_harmonics(values, n_harm=N_HARMONICS):
+    """Linear trend and strongest (lowest frequency) harmonics of the values,
+    returns the slope, amplitudes, phases and frequencies.
+    """
+    x = np.asarray(values, dtype=np.float64)
+    n = len(x)
+    t = np.arange(0, n)
+    p = np.polyfit(t, x, 1)         # find linear trend in x
+    x_notrend = x - p[0] * t        # detrended x
+    x_freqdom = fft.fft(x_notrend)  # detrended x in frequency domain
+    f = fft.fftfreq(n)              # frequencies
+    # sort indexes by frequency, lower -> higher
+    indexes = np.argsort(np.absolute(f), kind='stable')[:1 + n_harm * 2]
+
+    amplitudes = np.absolute(x_freqdom[indexes]) / n
+    phases = np.angle(x_freqdom[indexes])
+    return p[0], amplitudes, phases, f[indexes]
+
+
+def restore_harmonics(slope, amplitudes, phases, frequencies, t):
+    """Values of the trend and harmonics at the (fractional) positions t"""
+    restored_sig = np.zeros(t.size)
+    for ampli, phase, freq in zip(amplitudes, phases, frequencies):
+        restored_sig += ampli * np.cos(2 * np.pi * freq * t + phase)
+    return restored_sig + slope * t
+
+
+def fourier_extrapolation(values, n_predict, is_forecast=False, n_harm=N_HARMONICS):
+    """Reconstruct the detrended values from their strongest (lowest
+    frequency) harmonics, returns the history (is_forecast=False) or the
+    next n_predict values.
+    """
+    n = len(values)
+    t = np.arange(0 if not is_forecast else n, n + n_predict)
+    return restore_harmonics(*fourier_harmonics(values, n_harm), t)
+
+
+def batch_fourier_extrapolation(values, n_predict, is_forecast=False, n_harm=N_HARMONICS):
+    """Same as fourier_extrapolation for a 2D array with one series of equal
+    length per row, all series are handled in one vectorized pass.
+    """
+    x = np.asarray(values, dtype=np.float64)
+    m, n = x.shape
+    t = np.arange(0, n)
+    p = np.polyfit(t, x.T, 1)
+    slopes = p[0][:, None]
+    x_freqdom = fft.fft(x - slopes * t, axis=1)
+    f = fft.fftfreq(n)
+    indexes = np.argsort(np.absolute(f), kind='stable')[:1 + n_harm * 2]
+
+    t = np.arange(0 if not is_forecast else n, n + n_predict)
+    restored_sig = np.zeros((m, t.size))
+    amplitudes = np.absolute(x_freqdom[:, indexes]) / n
+    phases = np.angle(x_freqdom[:, indexes])
+    for i, freq in enumerate(f[indexes]):
+        restored_sig += amplitudes[:, i, None] * np.cos(2 * np.pi * freq * t + phases[:, i, None])
+
+    return restored_sig + slopes * t
+
+
+def mean_interval(timestamps):
+    """Interval between timestamps as summed by the FFE model, each
+    difference is divided by the number of points and truncated.
+    """
+    if len(timestamps) < 2:
+        return 0
+    diffs = np.diff(timestamps) / len(timestamps)
+    return int(np.trunc(diffs).astype(np.int64).sum())
+
+
+def forecast_timestamps(timestamps, n_predict):
+    interval = mean_interval(timestamps)
+    return int(timestamps[-1]) + interval * np.arange(1, n_predict + 1, dtype=np.int64)
+
+
+def average_difference(values, fe_values):
+    difference = np.absolute(values - fe_values)
+    # cumsum adds sequentially, like the accumulated average it replaces
+    return np.cumsum(difference / difference.shape[-1], axis=-1)[..., -1:]
+
+
+def find_anomaly_mask(values, fe_values, sensitivity, average=None):
+    """Mark values differing more than sensitivity times the average
+    difference from the extrapolated values.
+    """
+    if average is None:
+        average = average_difference(values, fe_values)
+    return np.absolute(values - fe_values) > sensitivity * average
+
+
+class FourierBaseline:
+    """Harmonics of a series and the average difference of its values, new
+    points are scored against it without reconstructing the history.
+    """
+
+    __slots__ = ('harmonics', 'num_points', 'last_timestamp', 'interval', 'average_difference')
+
+    def __init__(self, timestamps, values):
+        self.harmonics = fourier_harmonics(values)
+        self.num_points = len(values)
+        self.last_timestamp = int(timestamps[-1])
+        self.interval = detect_sampling_interval(timestamps)[0] or 1
+        self.average_difference = average_difference(values, self.restore(np.arange(0, len(values))))
+
+    def restore(self, t):
+        return restore_harmonics(*self.harmonics, t)
+
+    def positions(self, timestamps):
+        """Positions of points in the series, extrapolated from the sampling interval"""
+        return self.num_points - 1 + (timestamps - self.last_timestamp) / self.interval
 
 
 class FastFourierExtrapolationModel(Model):
 
-    def __init__(self, series_name, dataset, model_params):
+    def __init__(self, series_name, dataset, model_params, resolution=None):
         """
         Start modelling a time serie
         :param series_name: name of the serie
-        :param dataset: default siridb list of pairs
+        :param dataset: dataframe (Panda) with timestamps (0) and values (1)
+        :param resolution: aggregation interval in seconds of the dataset, None for raw points
         """
-        super().__init__(series_name, dataset, initialize=False)
+        super().__init__(series_name, dataset, resolution)
         self._model = None
         self._raw_dataset = dataset
         self._dataset = dataset
+        self._timestamps = dataset[0].to_numpy(dtype=np.int64)
+        self._values = dataset[1].to_numpy(dtype=np.float64)
         self._model_params = model_params
 
     def create_model(self):
@@ -31,85 +154,31 @@ class FastFourierExtrapolationModel(Model):
         :return:
         """
         n_predict = self._model_params.get('n_predict', 100)
-        return self._fourier_extrapolation(self._dataset, n_predict, is_forecast=True)
+        timestamps, values = remove_outliers(self._timestamps, self._values)
+        fe_values = fourier_extrapolation(values, n_predict, is_forecast=True)
+        fe_timestamps = forecast_timestamps(timestamps, n_predict)
+        return to_points(fe_timestamps, fe_values)
 
     def find_anomalies(self, points_since):
         sensitivity = self._model_params.get('anomaly_detection_sensitivity', 2)
-        fe = self._fourier_extrapolation(self._dataset, 0, is_forecast=False)
-
-        if len(fe) != len(self._dataset):
-            raise Exception("Unequal length between ts data and extrapolation")
-        
-        average_difference = 0
-        start_index_to_analyse = None
-        
-        for i in range(len(self._dataset)):
-            average_difference += abs(self._dataset[i][1] - fe[i][1]) / len(self._dataset)
-            if start_index_to_analyse is None and fe[i][0] >= points_since:
-                start_index_to_analyse = i
-
-        max_difference_from_fe = sensitivity * average_difference
-        anomalies = []
-
-        for i in range(start_index_to_analyse, len(self._dataset)):
-            if abs(self._dataset[i][1] - fe[i][1]) > max_difference_from_fe:
-                anomalies.append(self._dataset[i])
-
-        return anomalies
-
-    def _fourier_extrapolation(self, list_ts_values, n_predict, is_forecast=False):
-        if not is_forecast:
-            n_predict = 0
-        else:
-            df = pd.DataFrame.from_records(list_ts_values, columns=["ts", "value"])
-            y = df['value']
-            removed_outliers = y.between(y.quantile(.10), y.quantile(.90))
-            ndf = df[removed_outliers]
-            list_ts_values = [list(r) for r in ndf.to_records(index=False)]
-
-        x = [r[1] for r in list_ts_values]
-        n = len(x)
-        n_harm = 10                     # number of harmonics in model
-        t = np.arange(0, n)
-        p = np.polyfit(t, x, 1)         # find linear trend in x
-        x_notrend = x - p[0] * t        # detrended x
-        x_freqdom = fft.fft(x_notrend)  # detrended x in frequency domain
-        f = fft.fftfreq(n)              # frequencies
-        indexes = list(range(n))
-        # sort indexes by frequency, lower -> higher
-        indexes.sort(key = lambda i: np.absolute(f[i]))
-    
-        t = np.arange(0 if not is_forecast else n, n + n_predict)
-        restored_sig = np.zeros(t.size)
-        for i in indexes[:1 + n_harm * 2]:
-            ampli = np.absolute(x_freqdom[i]) / n   # amplitude
-            phase = np.angle(x_freqdom[i])          # phase
-            restored_sig += ampli * np.cos(2 * np.pi * f[i] * t + phase)
-        
-        fe_values = restored_sig + p[0] * t
-
-        fe_ts_v = []
-        original_data_set_length = len(list_ts_values)
-        last_timestamp = None
-        mean_interval = 0
-
-        if not is_forecast:
-            for i in range(len(fe_values)):
-                if i < len(list_ts_values):
-                    if last_timestamp is not None:
-                        mean_interval += int((list_ts_values[i][0] - last_timestamp) / original_data_set_length)
-                    last_timestamp = list_ts_values[i][0]
-                last_timestamp += mean_interval
-                current_ts = list_ts_values[i][0] if i < len(list_ts_values) else last_timestamp
-                fe_ts_v.append([int(current_ts), float(fe_values[i])])
-        else:
-            for i in range(len(list_ts_values)):
-                if last_timestamp is not None:
-                    mean_interval += int((list_ts_values[i][0] - last_timestamp) / original_data_set_length)
-                last_timestamp = list_ts_values[i][0]
-
-            last_timestamp = list_ts_values[-1][0]
-            for i in range(len(fe_values)):
-                last_timestamp = last_timestamp + mean_interval
-                fe_ts_v.append([int(last_timestamp), float(fe_values[i])])
-        return fe_ts_v
\ No newline at end of file
+        if not len(self._values):
+            return []
+        baseline = FourierBaseline(self._timestamps, self._values)
+        # Cache the baseline, so later detections can score new points only
+        self._cache_baseline('anomaly', baseline)
+        fe_values = baseline.restore(np.arange(0, len(self._values)))
+        anomalies = find_anomaly_mask(self._values, fe_values, sensitivity, baseline.average_difference)
+        anomalies &= self._timestamps >= points_since
+
+        return to_points(self._timestamps[anomalies], self._values[anomalies])
+
+    @classmethod
+    def find_new_anomalies(cls, cached, timestamps, values, model_params):
+        baseline, resolution = cached.model, cached.resolution
+        if resolution is not None and len(timestamps):
+            # Score the new points at the resolution the baseline is fitted on
+            timestamps, values = downsample(timestamps, values, resolution)
+        sensitivity = model_params.get('anomaly_detection_sensitivity', 2)
+        fe_values = baseline.restore(baseline.positions(timestamps))
+        anomalies = find_anomaly_mask(values, fe_values, sensitivity, baseline.average_difference)
+        return to_points(timestamps[anomalies], values[anomalies]), resolution
@@ -1,5 +1,4 @@
 import datetime
-import time
 
 import pandas as pd
 
@@ -7,21 +6,90 @@ import logging
 logger = logging.getLogger('fbprophet.plot')
 logger.setLevel(logging.CRITICAL)
 from fbprophet import Prophet
+from lib.analyser.cancellation import check_cancelled
 from lib.analyser.model.base import Model
+from lib.analyser.model.serialization import datetime_to_epoch, to_points
+from lib.analyser.resolution import downsample
+
+_warm_start = {
+    'max_warm_refits': 0,
+    'warm_start_ratio': 0,
+    'refit_window': 0,
+}
+
+
+def setup_prophet(max_warm_refits, warm_start_ratio, refit_window):
+    """
+    Configure warm started refits of Prophet models
+    :param max_warm_refits: number of warm started refits before a full refit, 0 disables warm starts
+    :param warm_start_ratio: warm start when a series got at most this ratio of new points
+    :param refit_window: fit a warm started model on only this number of most recent points, 0 for all
+    """
+    _warm_start['max_warm_refits'] = max_warm_refits
+    _warm_start['warm_start_ratio'] = warm_start_ratio
+    _warm_start['refit_window'] = refit_window
+
+
+def _stan_init(model):
+    """Retrieve the parameters of a fitted model to initialize a new fit"""
+    res = {}
+    for pname in ['k', 'm', 'sigma_obs']:
+        res[pname] = model.params[pname][0][0]
+    for pname in ['delta', 'beta']:
+        res[pname] = model.params[pname][0]
+    return res
+
+
+def _fit(create_prophet, dataframe, previous=None):
+    """Fit a new Prophet model, warm started from the previous fitted model when given"""
+    if previous is not None:
+        refit_window = _warm_start['refit_window']
+        window = dataframe.tail(refit_window) if refit_window else dataframe
+        try:
+            return create_prophet().fit(window, init=_stan_init(previous))
+        except Exception as e:
+            logging.debug(f'Warm started fit failed, falling back to a full fit: {str(e)}')
+        check_cancelled()
+    return create_prophet().fit(dataframe)
+
+
+def _anomaly_points(forecast, points_since=None):
+    """Points of a forecast with its facts outside the uncertainty interval"""
+    forecasted = forecast[['ds', 'trend', 'yhat', 'yhat_lower', 'yhat_upper', 'fact']].copy()
+
+    forecasted['anomaly'] = 0
+    forecasted.loc[forecasted['fact'] > forecasted['yhat_upper'], 'anomaly'] = 1
+    forecasted.loc[forecasted['fact'] < forecasted['yhat_lower'], 'anomaly'] = -1
+
+    # anomaly importances
+    forecasted['importance'] = 2
+    forecasted.loc[forecasted['anomaly'] == 1, 'importance'] = \
+        (forecasted['fact'] - forecasted['yhat_upper']) / forecast['fact']
+    forecasted.loc[forecasted['anomaly'] == -1, 'importance'] = \
+        (forecasted['yhat_lower'] - forecasted['fact']) / forecast['fact']
+
+    anomalies = forecasted[forecasted.anomaly != 0]
+    timestamps = datetime_to_epoch(anomalies['ds'])
+    if points_since is None:
+        return to_points(timestamps, anomalies['fact'])
+    since = timestamps >= points_since
+
+    return to_points(timestamps[since], anomalies['fact'].to_numpy()[since])
 
 
 class ProphetModel(Model):
 
-    def __init__(self, series_name, dataset, periods=None):
+    def __init__(self, series_name, dataset, periods=None, resolution=None):
         """
         Start modelling a time serie
         :param series_name: name of the serie
         :param dataset: dataframe (Panda) with datapoints
+        :param resolution: aggregation interval in seconds of the datapoints, None for raw points
         :param m: the seasonality factor
         :param d: the de-rending differencing factor
         :param d_large: the de-seasonality differencing factor
         """
-        super().__init__(series_name, dataset)
+        super().__init__(series_name, dataset, resolution)
         self._model = None
         self._raw_dataset = dataset
         self._dataset = dataset
@@ -35,9 +103,14 @@ class ProphetModel(Model):
         # remove outliers
         self._dataset = self._remove_outlier_in_df(self._dataset, 'y')
 
+    def _fit_cached_prophet(self, model_name, create_prophet, dataframe):
+        return self._fit_cached(
+            model_name, lambda previous: _fit(create_prophet, dataframe, previous),
+            max_warm_refits=_warm_start['max_warm_refits'],
+            warm_start_ratio=_warm_start['warm_start_ratio'])
+
     def create_model(self):
-        self._model = Prophet()
-        self._model.fit(self._dataset)
+        self._model = self._fit_cached_prophet('forecast', Prophet, self._dataset)
 
     def do_forecast(self, update=False):
         """
@@ -56,53 +129,32 @@ class ProphetModel(Model):
             future.tail()
 
             forecast = self._model.predict(future)
-            forecast.set_index('ds')
-
-            forecast['ds'] = pd.to_datetime(forecast['ds'], format="%Y-%m-%d %H:%M:%S")
-            indexed_forecast_values = []
-            for index, row in forecast.iterrows():
-                indexed_forecast_values.append(
-                    [int(time.mktime(datetime.datetime.strptime(str(row['ds']), "%Y-%m-%d %H:%M:%S").timetuple())),
-                     row['yhat']])
-
-                self.forecast_values = indexed_forecast_values
+            self.forecast_values = to_points(datetime_to_epoch(forecast['ds']), forecast['yhat'])
             return self.forecast_values
         else:
             return self.forecast_values
 
     def _predict_dateframe(self, dataframe):
-        m = Prophet(daily_seasonality=False, yearly_seasonality=False, weekly_seasonality=False,
-                    seasonality_mode='multiplicative',
-                    interval_width=0.99,
-                    changepoint_range=0.8)
-        m = m.fit(dataframe)
+        m = self._fit_cached_prophet('anomaly', lambda: Prophet(
+            daily_seasonality=False, yearly_seasonality=False, weekly_seasonality=False,
+            seasonality_mode='multiplicative',
+            interval_width=0.99,
+            changepoint_range=0.8), dataframe)
         forecast = m.predict(dataframe)
         forecast['fact'] = dataframe['y'].reset_index(drop=True)
         return forecast
 
     def find_anomalies(self, points_since):
         forecast = self._predict_dateframe(self._raw_dataset)
-
-        forecasted = forecast[['ds', 'trend', 'yhat', 'yhat_lower', 'yhat_upper', 'fact']].copy()
-
-        forecasted['anomaly'] = 0
-        forecasted.loc[forecasted['fact'] > forecasted['yhat_upper'], 'anomaly'] = 1
-        forecasted.loc[forecasted['fact'] < forecasted['yhat_lower'], 'anomaly'] = -1
-
-        # anomaly importances
-        forecasted['importance'] = 2
-        forecasted.loc[forecasted['anomaly'] == 1, 'importance'] = \
-            (forecasted['fact'] - forecasted['yhat_upper']) / forecast['fact']
-        forecasted.loc[forecasted['anomaly'] == -1, 'importance'] = \
-            (forecasted['yhat_lower'] - forecasted['fact']) / forecast['fact']
-
-        anomalies = forecasted[forecasted.anomaly != 0]
-
-        indexed_anomalies_values = []
-        for index, row in anomalies.iterrows():
-            df_unix_sec = int(row['ds'].timestamp())
-            if df_unix_sec >= points_since:
-                indexed_anomalies_values.append(
-                    [df_unix_sec, row['fact']])
-
-        return indexed_anomalies_values
+        return _anomaly_points(forecast, points_since)
+
+    @classmethod
+    def find_new_anomalies(cls, cached, timestamps, values, model_params):
+        m, resolution = cached.model, cached.resolution
+        if resolution is not None and len(timestamps):
+            # Score the new points at the resolution the model is fitted on
+            timestamps, values = downsample(timestamps, values, resolution)
+        dataframe = pd.DataFrame({'ds': pd.to_datetime(timestamps, unit='s'), 'y': values})
+        forecast = m.predict(dataframe)
+        forecast['fact'] = dataframe['y']
+        return _anomaly_points(forecast), resolution
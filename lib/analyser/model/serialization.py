@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+
+
+def datetime_to_epoch(datetimes):
+    """
+    Convert datetimes to unix timestamps in seconds, as an int64 array
+    :param datetimes: Series, Index or array with datetimes. Naive datetimes are taken as UTC, as they are
+        created from unix timestamps
+    """
+    datetimes = pd.DatetimeIndex(datetimes)
+    if datetimes.tz is not None:
+        datetimes = datetimes.tz_convert('UTC').tz_localize(None)
+    return datetimes.values.astype('datetime64[ns]').astype(np.int64) // 10 ** 9
+
+
+def to_points(timestamps, values):
+    """Create a list of [ts, value] points with native ints and floats"""
+    timestamps = np.asarray(timestamps, dtype=np.int64).tolist()
+    values = np.asarray(values, dtype=np.float64).tolist()
+    return [list(point) for point in zip(timestamps, values)]
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+
+from multiprocessing.connection import wait
+
+
+class _PipeQueue:
+    """Queue-like wrapper so the Analyser can put results on a pipe"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def put_threadsafe(self, result):
+        self._conn.send(('result', result))
+
+
+def _process_main(conn, settings):
+    """Entry point of a pool process, handles jobs until it receives None"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Import here so a spawned (not forked) process is warm before the
+    # first job arrives
+    from lib.analyser.analyser import _save_start_with_timeout, setup_analyser
+    from lib.siridb.siridb import create_siridb
+
+    setup_analyser(settings)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    queue = _PipeQueue(conn)
+    # One connection per process, reused by all jobs it executes
+    siridb_client = create_siridb(settings, loop=loop)
+    try:
+        while True:
+            try:
+                job_data = conn.recv()
+            except EOFError:
+                break
+            if job_data is None:
+                break
+            loop.run_until_complete(
+                _save_start_with_timeout(loop, queue, job_data,
+                                         siridb_client))
+            conn.send(('done', job_data.get('job_id')))
+    finally:
+        siridb_client.close()
+        # Let the connection tasks handle their cancellation
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+        conn.close()
+
+
+class _PoolProcess:
+
+    __slots__ = ('process', 'conn', 'job_id', 'cancelling')
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.job_id = None
+        # Set while cancel() waits for the process to exit, the process
+        # stays occupied and its results are no longer read
+        self.cancelling = False
+
+
+class AnalyserProcessPool:
+    """Pre-forked pool of processes executing analyser jobs
+
+    Every process handles one job at a time. Results are streamed back over
+    a pipe per process and put on the given result queue, so the worker
+    handles them the same way as results from analyser threads.
+    """
+
+    def __init__(self, size, result_queue, settings):
+        self._size = size
+        self._result_queue = result_queue
+        self._settings = settings
+        self._ctx = multiprocessing.get_context()
+        self._processes = []
+        self._lock = threading.Lock()
+        self._reader_thread = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        with self._lock:
+            for _ in range(self._size):
+                self._processes.append(self._spawn())
+        self._reader_thread = threading.Thread(
+            target=self._read_results, name='analyser-pool-reader',
+            daemon=True)
+        self._reader_thread.start()
+
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_process_main, args=(child_conn, self._settings),
+            name='analyser-pool-process', daemon=True)
+        process.start()
+        child_conn.close()
+        return _PoolProcess(process, parent_conn)
+
+    def _replace(self, pool_process):
+        """Replace a (terminated) process by a fresh one, lock must be held"""
+        pool_process.conn.close()
+        index = self._processes.index(pool_process)
+        if self._running:
+            self._processes[index] = self._spawn()
+        else:
+            del self._processes[index]
+
+    def submit(self, job_data):
+        with self._lock:
+            for pool_process in self._processes:
+                if pool_process.job_id is None:
+                    pool_process.job_id = job_data.get('job_id')
+                    pool_process.conn.send(job_data)
+                    return
+        raise Exception('No idle process available in analyser pool')
+
+    def cancel(self, job_id):
+        """Terminate the process running the job, frees its CPU and memory
+        immediately and starts a new process in its place.
+
+        Blocks until the process exited, call it from an executor. The lock
+        is not held while waiting so submit() and the reader are not blocked.
+        """
+        with self._lock:
+            for pool_process in self._processes:
+                if pool_process.job_id == job_id and not pool_process.cancelling:
+                    pool_process.cancelling = True
+                    pool_process.process.terminate()
+                    break
+            else:
+                return False
+        pool_process.process.join(2.0)
+        if pool_process.process.is_alive():
+            pool_process.process.kill()
+            pool_process.process.join()
+        with self._lock:
+            if pool_process in self._processes:
+                self._replace(pool_process)
+        return True
+
+    def _read_results(self):
+        while self._running:
+            with self._lock:
+                conns = {p.conn: p for p in self._processes if not p.cancelling}
+            if not conns:
+                if self._processes:
+                    # All processes are being cancelled
+                    time.sleep(.1)
+                    continue
+                break
+            try:
+                ready = wait(list(conns.keys()), timeout=1.0)
+            except OSError:
+                # A connection got closed by cancel(), retry with fresh set
+                continue
+            for conn in ready:
+                pool_process = conns[conn]
+                try:
+                    msg_type, msg = conn.recv()
+                except (EOFError, OSError):
+                    self._on_process_died(pool_process)
+                    continue
+                if msg_type == 'result':
+                    # Free the process before the worker sees the result and
+                    # frees the slot, so the next job finds an idle process
+                    with self._lock:
+                        if pool_process.job_id == msg.get('job_id'):
+                            pool_process.job_id = None
+                    self._result_queue.put_threadsafe(msg)
+                elif msg_type == 'done':
+                    with self._lock:
+                        if pool_process.job_id == msg:
+                            pool_process.job_id = None
+
+    def _on_process_died(self, pool_process):
+        with self._lock:
+            if pool_process not in self._processes or pool_process.cancelling:
+                # Terminated by cancel()
+                return
+            job_id = pool_process.job_id
+            logging.error('Analyser pool process died unexpectedly')
+            pool_process.process.join(1.0)
+            self._replace(pool_process)
+        if job_id is not None:
+            self._result_queue.put_threadsafe(
+                {'job_id': job_id, 'error': 'Analyser process died'})
+
+    def close(self):
+        self._running = False
+        with self._lock:
+            for pool_process in self._processes:
+                try:
+                    pool_process.conn.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+            for pool_process in self._processes:
+                pool_process.process.join(2.0)
+                if pool_process.process.is_alive():
+                    pool_process.process.terminate()
+                pool_process.conn.close()
+            self._processes = []
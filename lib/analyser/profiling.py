@@ -0,0 +1,101 @@
+import cProfile
+import logging
+import os
+import resource
+import sys
+import time
+
+from contextlib import contextmanager
+
+_settings = {
+    'threshold': 0,
+    'path': '',
+}
+
+
+def setup_profiling(threshold, path):
+    """
+    Configure dumping cProfile output of slow jobs
+    :param threshold: jobs taking longer than this number of seconds are dumped, 0 disables profiling
+    :param path: directory the profiles are written to, readable with pstats
+    """
+    _settings['threshold'] = threshold
+    _settings['path'] = path
+    if threshold and path:
+        os.makedirs(path, exist_ok=True)
+
+
+def _process_peak_memory():
+    """Peak resident memory of the process in bytes since it started, shared
+    by all jobs the process ran"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class JobProfile:
+    """Wall and CPU time per stage of a job and the number of points it
+    handled. CPU time is measured for the thread running the job, memory is
+    the peak of the whole process, not of the job.
+    """
+
+    def __init__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        self._stages = {}
+        self._points = {}
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            stage = self._stages.setdefault(name, {'wall': 0., 'cpu': 0.})
+            stage['wall'] += time.perf_counter() - wall
+            stage['cpu'] += time.thread_time() - cpu
+
+    def count_points(self, name, num_points):
+        self._points[name] = self._points.get(name, 0) + int(num_points)
+
+    @property
+    def wall_time(self):
+        return time.perf_counter() - self._wall
+
+    def to_dict(self):
+        return {
+            'wall': self.wall_time,
+            'cpu': time.thread_time() - self._cpu,
+            'process_peak_memory': _process_peak_memory(),
+            'stages': {name: dict(stage) for name, stage in self._stages.items()},
+            'points': dict(self._points),
+        }
+
+
+@contextmanager
+def profile_job(job_profile, job_id, job_type):
+    """Run a job under cProfile when profiling is enabled, the profile is
+    written when the job takes longer than the threshold.
+    """
+    threshold, path = _settings['threshold'], _settings['path']
+    profiler = None
+    if threshold and path:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can be active at a time on newer Pythons
+            profiler = None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            if job_profile.wall_time > threshold:
+                file_path = os.path.join(path, f'{job_id}-{job_type}-{int(time.time())}.prof')
+                try:
+                    profiler.dump_stats(file_path)
+                except OSError as e:
+                    logging.error('Error while writing job profile')
+                    logging.debug(f'Correspondig error: {str(e)}')
+                else:
+                    logging.info(f'Job {job_id} took {job_profile.wall_time:.1f}s, profile written to {file_path}')
@@ -0,0 +1,74 @@
+import numpy as np
+
+# Maximum number of points a model is fitted on, 0 for no limit
+_point_budgets = {}
+
+
+def setup_resolution(prophet_max_points, ffe_max_points):
+    """
+    Configure the number of points models are fitted on
+    :param prophet_max_points: point budget of Prophet models, 0 for no limit
+    :param ffe_max_points: point budget of FFE models, 0 for no limit
+    """
+    _point_budgets['prophet'] = prophet_max_points
+    _point_budgets['ffe'] = ffe_max_points
+
+
+def get_point_budget(model, model_params=None):
+    """Point budget of a model, the `max_points` model param takes precedence"""
+    max_points = (model_params or {}).get('max_points')
+    if max_points is not None:
+        return int(max_points)
+    return _point_budgets.get(model, 0)
+
+
+def choose_resolution(first_timestamp, last_timestamp, num_points, max_points):
+    """
+    Returns the aggregation interval in seconds which brings a series within
+    the point budget, or None when the raw points fit
+    """
+    if not max_points or num_points <= max_points:
+        return None
+    return max(-(-(int(last_timestamp) - int(first_timestamp) + 1) // max_points), 1)
+
+
+def downsample(timestamps, values, resolution):
+    """
+    Mean of the values per resolution seconds, like SiriDB's mean(<resolution>):
+    each mean gets the timestamp at the end of its interval
+    """
+    buckets = -(-timestamps // resolution)
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    sums = np.add.reduceat(values, starts)
+    counts = np.diff(np.append(starts, len(values)))
+    return buckets[starts] * resolution, sums / counts
+
+
+async def fetch_points_within_budget(siridb_client, series_name, max_points):
+    """
+    Fetch the points of a series, aggregated when the series exceeds the
+    point budget. Cached series are aggregated locally, others are
+    aggregated by SiriDB so only the aggregated points are transferred.
+    :return: tuple with the timestamps, values and resolution in seconds (None for raw points),
+        or None when the series could not be queried
+    """
+    series_range = None
+    if max_points and not siridb_client.is_cached(series_name):
+        series_range = await siridb_client.query_series_range(series_name)
+        if series_range is None:
+            return None
+        resolution = choose_resolution(series_range[1], series_range[2], series_range[0], max_points)
+        if resolution is not None:
+            series_points = await siridb_client.query_series_mean(series_name, resolution)
+            return None if series_points is None else (*series_points, resolution)
+
+    series_points = await siridb_client.query_series_points(series_name, series_range=series_range)
+    if series_points is None:
+        return None
+    timestamps, values = series_points
+    resolution = None
+    if len(timestamps):
+        resolution = choose_resolution(timestamps[0], timestamps[-1], len(timestamps), max_points)
+    if resolution is not None:
+        timestamps, values = downsample(timestamps, values, resolution)
+    return timestamps, values, resolution
@@ -0,0 +1,33 @@
+import numpy as np
+
+# Differences within this fraction of the typical interval count as regular
+JITTER_TOLERANCE = .1
+
+
+def detect_sampling_interval(timestamps):
+    """
+    Detect the interval between the points of a series
+    :param timestamps: array like with numeric timestamps or datetimes
+    :return: tuple with the interval, in the unit of the timestamps (nanoseconds for datetimes), and a
+        regularity score between 0 and 1, the fraction of intervals matching the detected interval.
+        (None, 0.0) when there are not enough points.
+
+    The typical interval is the median of the differences between points, so gaps and bursts do not
+    affect it. The returned interval is the mean of the differences within the jitter tolerance of the
+    median, which smooths out jitter. When no difference lies within the tolerance, e.g. for alternating
+    intervals, the median is returned with a regularity of 0.
+    """
+    timestamps = np.asarray(timestamps)
+    if np.issubdtype(timestamps.dtype, np.datetime64):
+        timestamps = timestamps.astype('datetime64[ns]').astype(np.int64)
+    diffs = np.diff(np.sort(timestamps))
+    diffs = diffs[diffs > 0]
+    if not len(diffs):
+        return None, 0.0
+
+    median = np.median(diffs)
+    regular = np.absolute(diffs - median) <= JITTER_TOLERANCE * median
+    if not regular.any():
+        # No typical interval, e.g. alternating intervals, fall back to the median
+        return float(median), 0.0
+    return float(diffs[regular].mean()), float(regular.mean())
@@ -0,0 +1,124 @@
+import time
+
+import numpy as np
+
+
+def rules_tail(static_rules):
+    """
+    Returns which tail of a series the rules need
+    :param static_rules: dict with static rules
+    :return: tuple with the window in seconds, or None when the last points are checked, and the
+        number of points to check. A window is preferred, the tail can be fetched from SiriDB then.
+    """
+    window = static_rules.get('window')
+    last_n_points = static_rules.get('last_n_points')
+    return (int(window) if window else None,
+            int(last_n_points) if last_n_points else None)
+
+
+def rules_history(static_rules):
+    """
+    Returns the number of points before the checked points the rules look back on, the
+    band_points of the rolling band and the point before the first checked point for the rate
+    and gap checks
+    """
+    if not any(static_rules.get(rule) is not None for rule in ('max_rate', 'max_gap', 'band_points')):
+        return 0
+    return int(static_rules.get('band_points') or 0) + 1
+
+
+def _rolling_band(values, checked, band_points):
+    """Mean and standard deviation of the band_points values before each
+    checked point, points without enough history are skipped.
+    """
+    indexes = np.flatnonzero(checked)
+    indexes = indexes[indexes >= band_points]
+    # Center the values to keep the sums of squares accurate
+    centered = values - values.mean()
+    sums = np.concatenate(([0.], np.cumsum(centered)))
+    squares = np.concatenate(([0.], np.cumsum(centered * centered)))
+    mean = (sums[indexes] - sums[indexes - band_points]) / band_points
+    var = (squares[indexes] - squares[indexes - band_points]) / band_points - mean * mean
+    return indexes, mean + values.mean(), np.sqrt(np.maximum(var, 0.))
+
+
+def check_static_rules(timestamps, values, static_rules, now=None):
+    """
+    Evaluate static rules on the tail of a series in one vectorized pass
+    :param timestamps: numpy array with the timestamps of the tail, in seconds
+    :param values: numpy array with the values of the tail
+    :param static_rules: dict with the rules, all optional:
+        min / max: values must stay within these thresholds
+        max_rate: maximum absolute change per second between two points
+        flatline_points: fail when this many last values are all equal
+        max_gap: maximum number of seconds between two points, and since the last point
+        band_points / band_sensitivity: values must stay within sensitivity (default 3) times the
+            standard deviation from the rolling mean of the band_points values before it
+        window / last_n_points: the points to check, the points within window seconds of now or the
+            last n points. Earlier points are only used as history.
+    :param now: current time in seconds, for the missing data check
+    :return: dict with a message per failed check
+    """
+    window, last_n_points = rules_tail(static_rules)
+    now = time.time() if now is None else now
+    failed_checks = {}
+
+    checked = np.ones(len(values), dtype=bool)
+    if window is not None:
+        checked &= timestamps > now - window
+    if last_n_points is not None:
+        checked[:-last_n_points] = False
+    checked_values = values[checked]
+
+    if not len(checked_values):
+        if window is not None or static_rules.get('max_gap') is not None:
+            failed_checks['missing'] = "Found no points to check."
+        return failed_checks
+
+    min_value = static_rules.get('min')
+    if min_value is not None:
+        data_min = checked_values.min()
+        if data_min < min_value:
+            failed_checks['min'] = f"Found value lower than min value. ({data_min} < {min_value})"
+
+    max_value = static_rules.get('max')
+    if max_value is not None:
+        data_max = checked_values.max()
+        if data_max > max_value:
+            failed_checks['max'] = f"Found value higher than max value. ({data_max} > {max_value})"
+
+    # The checked points are a tail of the series, changes and gaps are
+    # checked from the point before them
+    start = max(len(values) - len(checked_values) - 1, 0)
+    changed_timestamps, changed_values = timestamps[start:], values[start:]
+    intervals = np.diff(changed_timestamps)
+
+    max_rate = static_rules.get('max_rate')
+    if max_rate is not None and len(intervals):
+        positive = intervals > 0
+        rates = np.absolute(np.diff(changed_values)[positive] / intervals[positive])
+        if len(rates) and rates.max() > max_rate:
+            failed_checks['max_rate'] = f"Found change faster than max rate. ({rates.max()} > {max_rate})"
+
+    flatline_points = static_rules.get('flatline_points')
+    if flatline_points is not None and len(checked_values) >= int(flatline_points):
+        last_values = checked_values[-int(flatline_points):]
+        if last_values.min() == last_values.max():
+            failed_checks['flatline'] = f"Found {int(flatline_points)} equal values. ({last_values[-1]})"
+
+    max_gap = static_rules.get('max_gap')
+    if max_gap is not None:
+        gap = max(intervals.max() if len(intervals) else 0, now - changed_timestamps[-1])
+        if gap > max_gap:
+            failed_checks['max_gap'] = f"Found gap larger than max gap. ({gap} > {max_gap})"
+
+    band_points = static_rules.get('band_points')
+    if band_points is not None:
+        sensitivity = static_rules.get('band_sensitivity', 3)
+        indexes, mean, std = _rolling_band(values, checked, int(band_points))
+        outside = np.absolute(values[indexes] - mean) > sensitivity * std
+        if outside.any():
+            failed_checks['band'] = (f"Found {int(outside.sum())} values outside the rolling band. "
+                                     f"(last at {int(timestamps[indexes[outside][-1]])})")
+
+    return failed_checks
@@ -0,0 +1,58 @@
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+from statsmodels.tsa.stattools import adfuller
+
+# Only the most recent points are tested, downsampled to at most ADF_MAX_POINTS
+# so the lag search of the test stays cheap for large series
+ADF_WINDOW = 10000
+ADF_MAX_POINTS = 1000
+ADF_MIN_POINTS = 20
+MAX_CACHED_RESULTS = 1000
+
+_results = OrderedDict()
+_lock = threading.Lock()
+
+
+def _downsample(values, max_points):
+    factor = -(-len(values) // max_points)
+    if factor <= 1:
+        return values
+    values = values[len(values) % factor:]
+    return values.reshape(-1, factor).mean(axis=1)
+
+
+def stationarity_test(series_name, timestamps, values):
+    """
+    Augmented Dickey-Fuller test on a bounded window of the series
+    :param series_name: name of the series, results are memoised per series and data watermark
+    :param timestamps: numpy array with the timestamps of the series
+    :param values: numpy array with the values of the series
+    :return: dict with the p-value and whether the series is stationary, or None when the series has
+        not enough points
+    """
+    if len(values) < ADF_MIN_POINTS:
+        return None
+    key = (series_name, int(timestamps[-1]), len(values))
+    with _lock:
+        result = _results.get(key)
+        if result is not None:
+            _results.move_to_end(key)
+            return result
+
+    window = _downsample(np.asarray(values[-ADF_WINDOW:], dtype=np.float64), ADF_MAX_POINTS)
+    try:
+        p_value = float(adfuller(window, autolag='AIC')[1])
+    except Exception:
+        return None
+    result = {'p_value': p_value, 'stationary': p_value < .05}
+
+    with _lock:
+        for cached_key in [k for k in _results if k[0] == series_name]:
+            del _results[cached_key]
+        _results[key] = result
+        while len(_results) > MAX_CACHED_RESULTS:
+            _results.popitem(last=False)
+    return result
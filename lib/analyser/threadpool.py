@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import queue
+import threading
+
+from lib.analyser.analyser import _save_start_with_timeout
+from lib.siridb.siridb import create_siridb, create_series_cache
+
+
+class AnalyserThreadPool:
+    """Pool of long-lived threads executing analyser jobs
+
+    Every thread owns an event loop and a SiriDB connection for its lifetime
+    and takes jobs from a shared queue, one job at a time. The loop keeps
+    running while waiting for a job, so SiriDB keepalives and connection
+    events are handled. The series cache is shared by the threads. Results
+    are put on the given result queue.
+    """
+
+    def __init__(self, size, result_queue, settings):
+        self._size = size
+        self._result_queue = result_queue
+        self._settings = settings
+        self._jobs = queue.Queue()
+        self._threads = []
+        # Loop and wakeup event of every thread, set when a job is queued
+        self._wakeups = []
+
+    def start(self):
+        series_cache = create_series_cache(self._settings)
+        for i in range(self._size):
+            thread = threading.Thread(
+                target=self._thread_main, args=(series_cache,),
+                name=f'analyser-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _thread_main(self, series_cache):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        siridb_client = create_siridb(self._settings, loop=loop, series_cache=series_cache)
+        try:
+            loop.run_until_complete(self._serve(loop, siridb_client))
+        finally:
+            siridb_client.close()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
+    async def _serve(self, loop, siridb_client):
+        wakeup = asyncio.Event()
+        self._wakeups.append((loop, wakeup))
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                # Cleared and checked on the loop, a wakeup set by submit()
+                # afterwards is never missed
+                wakeup.clear()
+                if self._jobs.empty():
+                    await wakeup.wait()
+                continue
+            if job is None:
+                break
+            job_data, cancelled, done = job
+            try:
+                await _save_start_with_timeout(loop, self._result_queue, job_data, siridb_client, cancelled)
+            except Exception as e:
+                logging.error('Error while executing Analyzer')
+                logging.debug(f'Correspondig error: {str(e)}')
+            finally:
+                done.set()
+
+    def submit(self, job_data, cancelled=None):
+        """
+        Queue a job for the next idle thread
+        :param job_data: data of the job
+        :param cancelled: threading.Event which cancels the job at its next checkpoint
+        :return: threading.Event which is set when a thread finished the job
+        """
+        done = threading.Event()
+        self._jobs.put((job_data, cancelled, done))
+        self._wake()
+        return done
+
+    def _wake(self):
+        for loop, wakeup in list(self._wakeups):
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                # The loop of a stopped thread is closed
+                pass
+
+    def close(self):
+        """Stop the threads once they finished their current job, blocks
+        until they stopped for at most 2 seconds per thread, call it from an
+        executor.
+        """
+        for _ in self._threads:
+            self._jobs.put(None)
+        self._wake()
+        for thread in self._threads:
+            thread.join(2.0)
+        self._threads = []
@@ -0,0 +1,118 @@
+import asyncio
+import datetime
+import logging
+
+import qpack
+from enodo.client import Client
+from enodo.protocol.package import PACKET_HEADER_LEN, HANDSHAKE_OK, HANDSHAKE_FAIL, HEARTBEAT, RESPONSE_OK, \
+    UNKNOWN_CLIENT, create_header, read_header
+
+# Maximum number of bytes read from the socket at once
+READ_SIZE = 65536
+
+
+class WorkerClient(Client):
+    """Hub client handling packets as soon as they arrive
+
+    The enodo client polls the socket once a second and handles a single
+    packet per poll, which limits a worker to one job per second. This client
+    waits for the socket to become readable, buffers the received data and
+    handles every complete packet, packets may arrive in parts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._buffer = bytearray()
+        self._send_lock = asyncio.Lock()
+
+    async def _connect(self):
+        # A partial packet of a lost connection is never completed
+        self._buffer.clear()
+        await super()._connect()
+
+    def _heartbeat_due_in(self):
+        elapsed = (datetime.datetime.now() - self._last_heartbeat_send).total_seconds()
+        return max(int(self._heartbeat_interval) - elapsed, 0)
+
+    async def run(self):
+        while self._running:
+            if self._heartbeat_due_in() == 0:
+                await self._send_heartbeat()
+
+            await self._wait_readable(self._heartbeat_due_in() or 1)
+            await self._read_available()
+
+    async def _wait_readable(self, timeout):
+        fd = self._sock.fileno()
+        if fd == -1:
+            await asyncio.sleep(timeout)
+            return
+        readable = self.loop.create_future()
+        self.loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.loop.remove_reader(fd)
+
+    async def _read_available(self):
+        """Read the received data and handle the packets which are complete"""
+        while self._running:
+            try:
+                data = self._sock.recv(READ_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                data = b''
+            if not data:
+                await self._reconnect()
+                return
+            self._buffer += data
+
+        while len(self._buffer) >= PACKET_HEADER_LEN:
+            body_size, packet_type, _ = read_header(self._buffer)
+            packet_len = PACKET_HEADER_LEN + body_size
+            if len(self._buffer) < packet_len:
+                break
+            data = bytes(self._buffer[PACKET_HEADER_LEN:packet_len])
+            del self._buffer[:packet_len]
+            if len(data):
+                data = qpack.unpackb(data, decode='utf-8')
+            await self._handle_packet(packet_type, data)
+
+    async def _reconnect(self):
+        logging.warning("Connection lost, trying to reconnect")
+        self._connected = False
+        self._sock.close()
+        try:
+            await self.setup(self._cbs)
+        except Exception as e:
+            logging.error('Error while trying to setup client')
+            logging.debug(f'Correspondig error: {str(e)}')
+            await asyncio.sleep(5)
+
+    async def _handle_packet(self, packet_type, data):
+        if packet_type == HANDSHAKE_OK:
+            logging.info(f'Hands shaked with hub')
+        elif packet_type == HANDSHAKE_FAIL:
+            logging.warning(f'Hub does not want to shake hands')
+        elif packet_type == HEARTBEAT:
+            logging.debug(f'Heartbeat back from hub')
+        elif packet_type == RESPONSE_OK:
+            logging.debug(f'Hub received update correctly')
+        elif packet_type == UNKNOWN_CLIENT:
+            logging.error(f'Hub does not recognize us')
+            await self._handshake()
+        elif packet_type in self._cbs:
+            await self._cbs.get(packet_type)(data)
+        else:
+            logging.error(f'Message type not implemented: {packet_type}')
+
+    async def _send_message(self, length, message_type, data):
+        # Packets are sent whole, a partial send must not interleave with another packet
+        async with self._send_lock:
+            header = create_header(length, message_type, self._current_message_id)
+            # The packet id is a single byte in the header
+            self._current_message_id = (self._current_message_id + 1) % 256
+            await self.loop.sock_sendall(self._sock, header + data)
@@ -7,6 +7,10 @@ EMPTY_CONFIG_FILE = {
         'hub_port': '9103',
         'heartbeat_interval': '25',
         'max_job_duration': '120',
+        'max_concurrent_jobs': '1',
+        'executor': 'thread',
+        'metrics_host': '127.0.0.1',
+        'metrics_port': '0',
         'internal_security_token': ''
     },
     'siridb': {
@@ -15,6 +19,23 @@ EMPTY_CONFIG_FILE = {
         'user': '',
         'password': '',
         'database': '',
+        'series_cache_max_points': '5000000',
+        'series_cache_max_age': '3600',
+        'series_cache_path': '',
+    },
+    'analyser': {
+        'model_cache_size': '100',
+        'model_cache_reuse_ratio': '0.01',
+        'model_cache_path': '',
+        'prophet_max_warm_refits': '10',
+        'prophet_warm_start_ratio': '0.25',
+        'prophet_refit_window': '0',
+        'prophet_max_points': '5000',
+        'ffe_max_points': '0',
+        'incremental_max_new_ratio': '0.1',
+        'incremental_max_age': '86400',
+        'profile_threshold': '0',
+        'profile_path': '',
     }
 }
 
@@ -50,4 +71,9 @@ class EnodoConfigParser(RawConfigParser):
             return super(EnodoConfigParser, self).get(
                 section, option, raw=False, vars=None, fallback=_UNSET)
         except Exception as _:
+            if fallback is not _UNSET:
+                return fallback
+            default_value = EMPTY_CONFIG_FILE.get(section, {}).get(option)
+            if default_value:
+                return default_value
             raise Exception(f'Invalid config, missing option "{option}" in section "{section}" or environment variable "{option.upper()}"')
\ No newline at end of file
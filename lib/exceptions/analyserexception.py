@@ -8,3 +8,9 @@ class AnalysisInvalidArgumentException(Exception):
 
 class AnalysisInvalidDatasetSize(Exception):
     pass
+
+
+class JobCancelledException(BaseException):
+    """Raised at a checkpoint of a cancelled job. Like asyncio.CancelledError it
+    is no Exception, so handlers turning errors into job results let it pass."""
+    pass
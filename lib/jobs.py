@@ -0,0 +1,6 @@
+# Job types handled by this worker on top of the job types of enodo
+JOB_TYPE_FORECAST_SERIES_BATCH = "job_forecast_batch"
+JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES_BATCH = "job_anomaly_detect_batch"
+JOB_TYPE_STATIC_RULES_BATCH = "job_static_rules_batch"
+
+BATCH_JOB_TYPES = [JOB_TYPE_FORECAST_SERIES_BATCH, JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES_BATCH]
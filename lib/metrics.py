@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import math
+import threading
+
+# Default histogram buckets in seconds, from fast static rules to slow model fits
+DURATION_BUCKETS = (.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple('' if labels.get(name) is None else str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        for key, value in items:
+            yield f'{self.name}{_format_labels(dict(zip(self.label_names, key)))} {_format_value(value)}'
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def _render_samples(self, items):
+        for key, (counts, total) in items:
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = _format_labels({**labels, 'le': _format_value(bound)})
+                yield f'{self.name}_bucket{bucket_labels} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(labels)} {cumulative}'
+
+
+class MetricsRegistry:
+    """Metrics in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class WorkerMetrics(MetricsRegistry):
+    """Metrics of a worker, analyser metrics are taken from the profiles of
+    the job results so they are counted for every executor.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.jobs_received = self.counter(
+            'enodo_worker_jobs_received_total', 'Jobs received from the hub', ('job_type',))
+        self.jobs_refused = self.counter(
+            'enodo_worker_jobs_refused_total', 'Jobs refused or rejected', ('reason',))
+        self.jobs_completed = self.counter(
+            'enodo_worker_jobs_completed_total', 'Jobs with a result', ('job_type', 'model', 'status'))
+        self.jobs_cancelled = self.counter(
+            'enodo_worker_jobs_cancelled_total', 'Cancelled jobs', ('reason',))
+        self.job_duration = self.histogram(
+            'enodo_worker_job_duration_seconds', 'Time between receiving a job and its result',
+            ('job_type', 'model'))
+        self.job_queue_latency = self.histogram(
+            'enodo_worker_job_queue_latency_seconds',
+            'Time of a job spent outside the analyser, dispatching it and handing over its result')
+        self.stage_duration = self.histogram(
+            'enodo_worker_job_stage_duration_seconds', 'Wall time per analyser stage, e.g. the SiriDB fetch',
+            ('job_type', 'stage'))
+        self.points = self.counter(
+            'enodo_worker_points_total', 'Points fetched and returned by jobs', ('job_type', 'kind'))
+        self.running_jobs = self.gauge('enodo_worker_running_jobs', 'Jobs currently running')
+        self.stopping_jobs = self.gauge(
+            'enodo_worker_stopping_jobs', 'Cancelled jobs whose analyser thread or process did not stop yet')
+        self.free_slots = self.gauge('enodo_worker_free_slots', 'Jobs which can be accepted')
+
+    def observe_result(self, result, job_type, model, duration):
+        status = 'error' if 'error' in result else 'ok'
+        self.jobs_completed.inc(job_type=job_type, model=model, status=status)
+        self.job_duration.observe(duration, job_type=job_type, model=model)
+        profile = result.get('profile')
+        if not profile:
+            return
+        self.job_queue_latency.observe(max(duration - profile['wall'], 0.))
+        for stage, timing in profile['stages'].items():
+            self.stage_duration.observe(timing['wall'], job_type=job_type, stage=stage)
+        for kind, num_points in profile['points'].items():
+            self.points.inc(num_points, job_type=job_type, kind=kind)
+
+
+async def start_metrics_server(registry, host, port):
+    """Serve the metrics of the registry over HTTP on every path"""
+
+    async def handle(reader, writer):
+        try:
+            # Read the request line and headers, the request itself is not used
+            while (await reader.readline()).strip():
+                pass
+            body = registry.render().encode('utf-8')
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n' +
+                         f'Content-Length: {len(body)}\r\n'.encode('ascii') +
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.debug(f'Metrics request failed: {str(e)}')
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+from lib.siridb.store import SeriesStore
+
+
+def points_to_arrays(points):
+    """Convert SiriDB [[ts, value], ...] points to timestamp and value arrays"""
+    timestamps = np.fromiter((p[0] for p in points), dtype=np.int64, count=len(points))
+    values = np.fromiter((p[1] for p in points), dtype=np.float64, count=len(points))
+    return timestamps, values
+
+
+class SeriesCacheEntry:
+
+    __slots__ = ('timestamps', 'values', 'fetched_at')
+
+    def __init__(self, timestamps, values, fetched_at=None):
+        timestamps.flags.writeable = False
+        values.flags.writeable = False
+        self.timestamps = timestamps
+        self.values = values
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+
+    @property
+    def last_timestamp(self):
+        return int(self.timestamps[-1])
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+class SeriesCache:
+    """Local cache with the points of series, so only newer points need to be
+    fetched from SiriDB for repeating jobs on the same series.
+
+    Series are evicted least recently used first when the total number of
+    cached points exceeds max_points. An entry older than max_age seconds
+    is dropped, so removed or back-filled points are picked up by a full
+    fetch once in a while.
+
+    When a store path is given the points are kept in a SeriesStore and the
+    cached arrays are memory-mapped, cached series then survive restarts and
+    are shared by processes using the same path.
+    """
+
+    def __init__(self, max_points, max_age, store_path=None):
+        self._max_points = max_points
+        self._max_age = max_age
+        self._entries = OrderedDict()
+        self._num_points = 0
+        self._lock = threading.Lock()
+        self._store = SeriesStore(store_path) if store_path else None
+
+    def _is_expired(self, entry):
+        return self._max_age and time.time() - entry.fetched_at > self._max_age
+
+    def get(self, series_name):
+        with self._lock:
+            entry = self._entries.get(series_name)
+            if entry is None and self._store is not None:
+                stored = self._store.load(series_name)
+                if stored is not None:
+                    entry = SeriesCacheEntry(*stored)
+                    if not self._is_expired(entry):
+                        self._add(series_name, entry)
+            if entry is None:
+                return None
+            if self._is_expired(entry):
+                self._remove(series_name)
+                return None
+            self._entries.move_to_end(series_name)
+            return entry
+
+    def set(self, series_name, timestamps, values):
+        if not len(timestamps):
+            return
+        with self._lock:
+            self._remove(series_name)
+            entry = SeriesCacheEntry(timestamps, values)
+            if self._store is not None and len(entry) <= self._max_points:
+                entry = SeriesCacheEntry(
+                    *self._store.write(series_name, timestamps, values, entry.fetched_at),
+                    fetched_at=entry.fetched_at)
+            self._add(series_name, entry)
+
+    def extend(self, series_name, entry, timestamps, values):
+        """Append points newer than the cached points of the given entry,
+        returns the new timestamps and values of the series.
+        """
+        with self._lock:
+            current = self._entries.get(series_name, entry)
+            new_points = timestamps > current.last_timestamp
+            if not new_points.any():
+                return current.timestamps, current.values
+            timestamps, values = timestamps[new_points], values[new_points]
+            mapped = None
+            if self._store is not None:
+                mapped = self._store.append(series_name, len(current), timestamps, values)
+            if mapped is None:
+                timestamps = np.concatenate((current.timestamps, timestamps))
+                values = np.concatenate((current.values, values))
+                if self._store is not None and len(timestamps) <= self._max_points:
+                    mapped = self._store.write(series_name, timestamps, values, current.fetched_at)
+            extended = SeriesCacheEntry(
+                *(mapped or (timestamps, values)), fetched_at=current.fetched_at)
+            self._remove(series_name)
+            self._add(series_name, extended)
+            return extended.timestamps, extended.values
+
+    def remove(self, series_name):
+        with self._lock:
+            self._remove(series_name)
+
+    def _add(self, series_name, entry):
+        if len(entry) > self._max_points:
+            if self._store is not None:
+                self._store.remove(series_name)
+            return
+        self._entries[series_name] = entry
+        self._num_points += len(entry)
+        while self._num_points > self._max_points:
+            evicted_name, evicted = self._entries.popitem(last=False)
+            self._num_points -= len(evicted)
+            if self._store is not None:
+                self._store.remove(evicted_name)
+
+    def _remove(self, series_name):
+        entry = self._entries.pop(series_name, None)
+        if entry is not None:
+            self._num_points -= len(entry)
@@ -1,56 +1,353 @@
+import asyncio
 import logging
 
+import numpy as np
+
 from siridb.connector import SiriDBClient
 from siridb.connector.lib.exceptions import QueryError, InsertError, ServerError, PoolError, AuthenticationError, \
     UserAuthError
 
+from lib.siridb.cache import SeriesCache, points_to_arrays
+
+# Keep queries for many series at a reasonable length
+MAX_SERIES_PER_QUERY = 250
+# Larger series are fetched in time windows, so the decoded points of only
+# one window are held in memory next to the arrays
+MAX_POINTS_PER_QUERY = 500000
+# The last points of a series are fetched within this many times the span
+# they are expected to cover
+TAIL_SPAN_MARGIN = 1.2
+# Cached series whose last cached points lie within this many seconds share
+# one query for their new points, others are queried apart
+WATERMARK_GROUP_SPAN = 3600
+
+
+def create_series_cache(settings):
+    """Create the series cache from the analyser settings, None when disabled"""
+    cache_settings = settings.get('series_cache')
+    if cache_settings and cache_settings.get('max_points'):
+        return SeriesCache(**cache_settings)
+    return None
+
+
+def create_siridb(settings, loop=None, series_cache=None):
+    """Create a SiriDB connection from the analyser settings, the series
+    cache is created from the settings unless a (shared) cache is given"""
+    if series_cache is None:
+        series_cache = create_series_cache(settings)
+    return SiriDB(**settings['siridb'], loop=loop, series_cache=series_cache)
+
+
+def group_by_watermark(entries, span=WATERMARK_GROUP_SPAN):
+    """Group series cache entries whose last timestamps lie within span
+    seconds of the oldest entry of the group, returns a list of tuples with
+    that oldest last timestamp and a dict with the entries of the group.
+    """
+    groups = []
+    for series_name, entry in sorted(entries.items(), key=lambda item: item[1].last_timestamp):
+        if groups and entry.last_timestamp - groups[-1][0] <= span:
+            groups[-1][1][series_name] = entry
+        else:
+            groups.append((entry.last_timestamp, {series_name: entry}))
+    return groups
+
+
+def parse_hostlist(siridb_host, siridb_port):
+    """Parse a comma separated list of hosts, each host may contain a port.
+    e.g. "siridb1:9000,siridb2" -> [('siridb1', 9000), ('siridb2', siridb_port)]
+    """
+    hostlist = []
+    for host in str(siridb_host).split(','):
+        host = host.strip()
+        if not host:
+            continue
+        hostname, _, port = host.partition(':')
+        hostlist.append((hostname, int(port or siridb_port)))
+    return hostlist
+
 
 class SiriDB:
+    """Long-lived SiriDB connection shared by the jobs of an analyser thread or process
+
+    The connection is bound to the event loop it is created on, which runs all
+    jobs of its thread or process. Jobs reuse the connection instead of
+    connecting and authenticating for each query. Reconnecting with backoff
+    and multiple hosts are handled by the SiriDB client.
+    """
     siri = None
     siridb_connected = False
     siridb_status = ""
 
-    def __init__(self, siridb_user, siridb_password, siridb_db, siridb_host, siridb_port):
+    def __init__(self, siridb_user, siridb_password, siridb_db, siridb_host, siridb_port, loop=None,
+                 series_cache=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._connect_lock = None
+        self._series_cache = series_cache
         self.siri = SiriDBClient(
             username=siridb_user,
             password=siridb_password,
             dbname=siridb_db,
-            hostlist=[(siridb_host, siridb_port)],  # Multiple connections are supported
+            hostlist=parse_hostlist(siridb_host, siridb_port),
+            loop=self._loop,
             keepalive=True)
 
+    async def _connect(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if not self.siri.connected:
+                await self.siri.connect()
+            self.siridb_connected = self.siri.connected
+
+    async def query(self, query):
+        if not self.siri.connected:
+            await self._connect()
+        return await self.siri.query(query)
+
     # @classmethod
     async def query_series_datapoint_count(self, series_name):
-        await self.siri.connect()
         count = None
         try:
-            result = await self.siri.query(f'select count() from "{series_name}"')
+            result = await self.query(f'select count() from "{series_name}"')
         except (QueryError, InsertError, ServerError, PoolError, AuthenticationError, UserAuthError) as e:
             logging.error('Connection problem with SiriDB server')
         else:
             count = result.get(series_name, [])[0][1]
-        self.siri.close()
         return count
 
     # @classmethod
-    async def query_series_data(self, series_name, selector="*"):
-        await self.siri.connect()
+    async def query_series_data(self, series_name, selector="*", after=None):
+        return await self._select(f'"{series_name}"', selector, after)
+
+    async def _select(self, series_selector, selector="*", after=None, between=None):
         result = None
+        query = f'select {selector} from {series_selector}'
+        if between is not None:
+            query += f' between {between[0]} and {between[1]}'
+        elif after is not None:
+            query += f' after {after}'
         try:
-            result = await self.siri.query(f'select {selector} from "{series_name}"')
+            result = await self.query(query)
         except (QueryError, InsertError, ServerError, PoolError, AuthenticationError, UserAuthError) as e:
             logging.error('Connection problem with SiriDB server')
-        self.siri.close()
         return result
 
+    async def _select_series_list(self, series_names, after=None):
+        result = {}
+        series_names = list(series_names)
+        for i in range(0, len(series_names), MAX_SERIES_PER_QUERY):
+            series_selector = ', '.join(f'"{series_name}"' for series_name in series_names[i:i + MAX_SERIES_PER_QUERY])
+            chunk_result = await self._select(series_selector, after=after)
+            if chunk_result is None:
+                return None
+            result.update(chunk_result)
+        return result
+
+    async def query_series_range(self, series_name, after=None):
+        """Returns the number of points, first and last timestamp of a series"""
+        result = await self._select(
+            f'"{series_name}"',
+            'count() prefix "count-", first() prefix "first-", last() prefix "last-"',
+            after)
+        if result is None:
+            return None
+        count = result.get(f'count-{series_name}')
+        if not count:
+            return 0, None, None
+        return count[0][1], result[f'first-{series_name}'][0][0], result[f'last-{series_name}'][0][0]
+
+    def is_cached(self, series_name):
+        return self._series_cache is not None and self._series_cache.get(series_name) is not None
+
+    async def query_series_mean(self, series_name, interval):
+        """Returns the timestamps and mean values per interval seconds of a
+        series, aggregated by SiriDB, or None when it could not be queried.
+        """
+        result = await self.query_series_data(series_name, selector=f'mean({int(interval)}s)')
+        if result is None:
+            return None
+        return points_to_arrays(result.get(series_name, []))
+
+    async def _fetch_series_arrays(self, series_name, after=None, series_range=None):
+        """Fetch the points of a series into numpy arrays. Points after a
+        timestamp, e.g. extending a cached series, are fetched in one query.
+        Whole series larger than MAX_POINTS_PER_QUERY are fetched window by
+        window into preallocated arrays, instead of decoding all points as
+        lists at once. The range of the series is queried unless given.
+        """
+        count = 0
+        if after is None:
+            if series_range is None:
+                series_range = await self.query_series_range(series_name)
+            if series_range is None:
+                return None
+            count, first, last = series_range
+        if count <= MAX_POINTS_PER_QUERY:
+            result = await self.query_series_data(series_name, after=after)
+            if result is None:
+                return None
+            return points_to_arrays(result.get(series_name, []))
+
+        num_windows = -(-count // MAX_POINTS_PER_QUERY)
+        bounds = np.linspace(first, last + 1, num_windows + 1).astype(np.int64)
+        timestamps = np.empty(count, dtype=np.int64)
+        values = np.empty(count, dtype=np.float64)
+        size = 0
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            result = await self._select(f'"{series_name}"', between=(start, end))
+            if result is None:
+                return None
+            window_timestamps, window_values = points_to_arrays(result.get(series_name, []))
+            in_window = (window_timestamps >= start) & (window_timestamps < end)
+            if not in_window.all():
+                window_timestamps, window_values = window_timestamps[in_window], window_values[in_window]
+            n = len(window_timestamps)
+            if size + n > len(timestamps):
+                # Points were added since counting
+                timestamps = np.resize(timestamps, size + n)
+                values = np.resize(values, size + n)
+            timestamps[size:size + n] = window_timestamps
+            values[size:size + n] = window_values
+            size += n
+        return timestamps[:size], values[:size]
+
+    async def query_series_points(self, series_name, series_range=None):
+        """Returns the timestamps and values of all points of a series as
+        numpy arrays, or None when the series could not be queried. When the
+        series is cached only points after the last cached point are fetched.
+        :param series_range: result of query_series_range when already known
+        """
+        entry = None
+        if self._series_cache is not None:
+            entry = self._series_cache.get(series_name)
+
+        arrays = await self._fetch_series_arrays(
+            series_name, after=entry.last_timestamp if entry is not None else None, series_range=series_range)
+        if arrays is None:
+            return None
+        timestamps, values = arrays
+
+        if self._series_cache is None:
+            return timestamps, values
+        if entry is None:
+            self._series_cache.set(series_name, timestamps, values)
+            return timestamps, values
+        return self._series_cache.extend(series_name, entry, timestamps, values)
+
+    async def query_series_points_since(self, series_name, since):
+        """Returns the timestamps and values of the points of a series at or
+        after since, or None when the series could not be queried. The series
+        cache is bypassed, only these points are fetched.
+        """
+        series_points = await self._fetch_series_arrays(series_name, after=int(since))
+        if series_points is None:
+            return None
+        # The start bound of after is inclusive, filter explicitly so the
+        # points match the points since a full detection checks
+        timestamps, values = series_points
+        keep = timestamps >= since
+        if not keep.all():
+            timestamps, values = timestamps[keep], values[keep]
+        return timestamps, values
+
+    async def query_series_tail(self, series_name, window):
+        """Returns the timestamps and values of the points of a series within
+        the last window seconds, or None when the series could not be queried.
+        """
+        result = await self.query_series_data(series_name, after=f'now - {int(window)}s')
+        if result is None:
+            return None
+        return points_to_arrays(result.get(series_name, []))
+
+    async def query_series_last_points(self, series_name, num_points, before=None):
+        """Returns the timestamps and values of the last num_points points of
+        a series, or of the points before the `before` timestamp, or None when
+        the series could not be queried. The points are fetched within a time
+        span estimated from the average interval of the series, which is
+        widened until enough points are fetched.
+        """
+        series_range = await self.query_series_range(series_name)
+        if series_range is None:
+            return None
+        count, first, last = series_range
+        end = last + 1 if before is None or count == 0 else min(int(before), last + 1)
+        if count == 0 or num_points <= 0 or end <= first:
+            return points_to_arrays([])
+        span = int((last - first) / max(count - 1, 1) * num_points * TAIL_SPAN_MARGIN) + 1
+        while True:
+            start = max(end - span, first)
+            result = await self._select(f'"{series_name}"', between=(start, end))
+            if result is None:
+                return None
+            timestamps, values = points_to_arrays(result.get(series_name, []))
+            in_span = (timestamps >= start) & (timestamps < end)
+            if not in_span.all():
+                timestamps, values = timestamps[in_span], values[in_span]
+            if len(timestamps) >= num_points or start == first:
+                return timestamps[-num_points:], values[-num_points:]
+            span *= 2
+
+    async def query_multiple_series_tail(self, series_names, window, series_selector=None):
+        """Returns a dict with the timestamps and values of the points within
+        the last window seconds of each series, or None when the series could
+        not be queried. With a series selector (a regex or group matching the
+        series) all series are fetched in one query.
+        """
+        after = f'now - {int(window)}s'
+        if series_selector is not None:
+            result = await self._select(series_selector, after=after)
+        else:
+            result = await self._select_series_list(series_names, after=after)
+        if result is None:
+            return None
+        return {series_name: points_to_arrays(result.get(series_name, [])) for series_name in series_names}
+
+    async def query_multiple_series_points(self, series_names):
+        """Returns a dict with the timestamps and values of each series, or
+        None when the series could not be queried. Uncached series are
+        fetched at once, cached series for the points after their last
+        cached point, at once for series whose last points are close.
+        """
+        entries = {}
+        if self._series_cache is not None:
+            for series_name in series_names:
+                entry = self._series_cache.get(series_name)
+                if entry is not None:
+                    entries[series_name] = entry
+        uncached = [series_name for series_name in series_names if series_name not in entries]
+
+        series_points = {}
+        if uncached:
+            result = await self._select_series_list(uncached)
+            if result is None:
+                return None
+            for series_name in uncached:
+                timestamps, values = points_to_arrays(result.get(series_name, []))
+                if self._series_cache is not None:
+                    self._series_cache.set(series_name, timestamps, values)
+                series_points[series_name] = timestamps, values
+        for last_timestamp, group in group_by_watermark(entries):
+            result = await self._select_series_list(group, after=last_timestamp)
+            if result is None:
+                return None
+            for series_name, entry in group.items():
+                timestamps, values = points_to_arrays(result.get(series_name, []))
+                series_points[series_name] = self._series_cache.extend(series_name, entry, timestamps, values)
+        return series_points
+
     async def test_connection(self):
         try:
-            await self.siri.connect()
+            await self._connect()
         except Exception:
             return "Cannot connect", False
 
         try:
-            await self.siri.query(f'show dbname')
+            await self.query(f'show dbname')
         except (QueryError, InsertError, ServerError, PoolError, AuthenticationError, UserAuthError) as e:
             return repr(e), False
         else:
             return "", True
+
+    def close(self):
+        self.siri.close()
+        self.siridb_connected = False
@@ -0,0 +1,140 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+
+from contextlib import contextmanager
+
+import numpy as np
+
+TIMESTAMPS_DTYPE = np.dtype('<i8')
+VALUES_DTYPE = np.dtype('<f8')
+
+
+class SeriesStore:
+    """On-disk store with the points of cached series
+
+    Every series is stored as two append-only columns, int64 timestamps and
+    float64 values, which are memory-mapped into numpy arrays when loaded.
+    Cached series therefore survive a restart of the worker and can be shared
+    by the pool processes without parsing or copying the points.
+
+    A small meta file holds the number of committed points, it is replaced
+    atomically after the columns are written. Readers only map the committed
+    points, so bytes of an interrupted append are ignored and overwritten by
+    the next append. Readers take a shared lock, so they never combine the
+    meta and columns of different writes.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _base_path(self, series_name):
+        return os.path.join(
+            self._path, hashlib.sha1(series_name.encode('utf-8')).hexdigest())
+
+    @contextmanager
+    def _locked(self, base_path, operation=fcntl.LOCK_EX):
+        lock_path = f'{base_path}.lock'
+        while True:
+            with open(lock_path, 'a') as fh:
+                fcntl.flock(fh, operation)
+                try:
+                    # The lock file may be removed while waiting for the lock,
+                    # the lock is only valid on the file which is in place
+                    try:
+                        in_place = os.stat(lock_path).st_ino == os.fstat(fh.fileno()).st_ino
+                    except FileNotFoundError:
+                        in_place = False
+                    if in_place:
+                        yield
+                        return
+                finally:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _read_meta(self, base_path):
+        try:
+            with open(f'{base_path}.meta', 'r') as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, base_path, meta):
+        tmp_path = f'{base_path}.meta.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(meta, fh)
+        os.replace(tmp_path, f'{base_path}.meta')
+
+    def _map(self, base_path, count):
+        if count == 0:
+            return (np.empty(0, dtype=TIMESTAMPS_DTYPE),
+                    np.empty(0, dtype=VALUES_DTYPE))
+        return (np.memmap(f'{base_path}.ts', dtype=TIMESTAMPS_DTYPE, mode='r', shape=(count,)),
+                np.memmap(f'{base_path}.val', dtype=VALUES_DTYPE, mode='r', shape=(count,)))
+
+    def load(self, series_name):
+        """Returns the memory-mapped timestamps, values and fetch time of a
+        series, or None when the series is not stored.
+        """
+        base_path = self._base_path(series_name)
+        if not os.path.exists(f'{base_path}.meta'):
+            return None
+        with self._locked(base_path, fcntl.LOCK_SH):
+            meta = self._read_meta(base_path)
+            if meta is None or meta.get('series_name') != series_name:
+                return None
+            try:
+                timestamps, values = self._map(base_path, meta['count'])
+            except (OSError, ValueError) as e:
+                logging.debug(f'Unable to load stored series "{series_name}": {str(e)}')
+                return None
+            return timestamps, values, meta['fetched_at']
+
+    def write(self, series_name, timestamps, values, fetched_at):
+        """Replace the stored points of a series, returns the mapped arrays"""
+        base_path = self._base_path(series_name)
+        with self._locked(base_path):
+            # Write new files and replace the old ones, so arrays which are
+            # still mapped by others keep referring to the old files
+            for ext, arr, dtype in (('ts', timestamps, TIMESTAMPS_DTYPE),
+                                    ('val', values, VALUES_DTYPE)):
+                tmp_path = f'{base_path}.{ext}.tmp'
+                with open(tmp_path, 'wb') as fh:
+                    fh.write(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+                os.replace(tmp_path, f'{base_path}.{ext}')
+            self._write_meta(base_path, {
+                'series_name': series_name,
+                'count': len(timestamps),
+                'fetched_at': fetched_at})
+            return self._map(base_path, len(timestamps))
+
+    def append(self, series_name, count, timestamps, values):
+        """Append points to a stored series which has count committed points,
+        returns the mapped arrays or None when the stored series has changed
+        in the meantime and should be written again.
+        """
+        base_path = self._base_path(series_name)
+        with self._locked(base_path):
+            meta = self._read_meta(base_path)
+            if meta is None or meta.get('series_name') != series_name or meta['count'] != count:
+                return None
+            for ext, arr, dtype in (('ts', timestamps, TIMESTAMPS_DTYPE),
+                                    ('val', values, VALUES_DTYPE)):
+                with open(f'{base_path}.{ext}', 'r+b') as fh:
+                    fh.seek(count * dtype.itemsize)
+                    fh.write(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+                    fh.truncate()
+            meta['count'] = count + len(timestamps)
+            self._write_meta(base_path, meta)
+            return self._map(base_path, meta['count'])
+
+    def remove(self, series_name):
+        base_path = self._base_path(series_name)
+        with self._locked(base_path):
+            for ext in ('meta', 'ts', 'val', 'lock'):
+                try:
+                    os.remove(f'{base_path}.{ext}')
+                except FileNotFoundError:
+                    pass
@@ -1 +1 @@
-from .util import wait_for_with_cancel
\ No newline at end of file
+from .util import wait_for_with_cancel, ThreadsafeQueue
\ No newline at end of file
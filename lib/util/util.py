@@ -1,8 +1,23 @@
 import functools
-from asyncio import events, ensure_future, futures
+from asyncio import events, ensure_future, futures, Queue
 from asyncio.tasks import _release_waiter, _cancel_and_wait
 
 
+class ThreadsafeQueue(Queue):
+    """Asyncio queue which can be filled from other threads
+
+    Items put with put_threadsafe() are handed to the loop with
+    call_soon_threadsafe, so a consumer awaiting get() wakes up directly.
+    """
+
+    def __init__(self, loop):
+        super().__init__()
+        self._owner_loop = loop
+
+    def put_threadsafe(self, item):
+        self._owner_loop.call_soon_threadsafe(self.put_nowait, item)
+
+
 async def _waiter_check_cancel(cb):
     while True:
         if await cb():
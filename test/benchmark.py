@@ -0,0 +1,252 @@
+"""Benchmarks of the models and the job pipeline on synthetic series
+
+Usage:
+    python test/benchmark.py [--quick] [--output results.json] [--baseline baseline.json]
+
+Every case is timed a number of times, the minimum and median wall time are
+written as JSON. With a baseline the medians are compared and the script
+exits with status 1 when a case got slower than the tolerance allows.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+from enodo.jobs import JOB_TYPE_FORECAST_SERIES, JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, \
+    JOB_TYPE_BASE_SERIES_ANALYSIS, JOB_TYPE_STATIC_RULES
+
+from lib.analyser import stationarity
+from lib.analyser.analyser import Analyser, setup_analyser
+from lib.analyser.baseanalysis import basic_series_analysis
+from lib.analyser.model.autoregressionmodel import AutoRegressionModel
+from lib.analyser.model.ffemodel import FastFourierExtrapolationModel
+from lib.analyser.model.prophetmodel import ProphetModel
+from lib.analyser.staticrules import check_static_rules
+from lib.config import EMPTY_CONFIG_FILE
+from synthetic import generate_series, SyntheticData, FakeSiriDB
+
+SIZES = (1000, 10000, 100000)
+QUICK_SIZES = (1000, 10000)
+# Prophet and AR fits grow superlinearly, larger series take minutes
+MAX_FIT_SIZE = 10000
+
+STATIC_RULES = {'min': 0, 'max': 200, 'max_rate': 1, 'flatline_points': 10, 'max_gap': 600,
+                'band_points': 60, 'last_n_points': 1000}
+
+
+class _ResultCollector:
+
+    def __init__(self):
+        self.results = []
+
+    def put_threadsafe(self, result):
+        self.results.append(result)
+
+
+def _dataset(timestamps, values):
+    return pd.DataFrame({0: timestamps, 1: values})
+
+
+def _job(job_type, series_name, model='ffe', model_params=None, points_since=None):
+    return {
+        'job_id': 1,
+        'job_type': job_type,
+        'series_name': series_name,
+        'series_config': {
+            'model_params': {'points_since': points_since},
+            'job_config': {job_type: {'model': model, 'model_params': model_params or {}}},
+            JOB_TYPE_BASE_SERIES_ANALYSIS: {'model_params': {'static_rules': STATIC_RULES}},
+        }
+    }
+
+
+def _run_job(siridb, job_data):
+    queue = _ResultCollector()
+    asyncio.run(Analyser(queue, siridb).execute_job(job_data))
+    for result in queue.results:
+        if 'error' in result:
+            raise Exception(result['error'])
+
+
+def build_cases(sizes):
+    """Returns a list with (name, number of points, function) per case"""
+    cases = []
+    data = SyntheticData()
+    siridb = FakeSiriDB(data)
+    for size in sizes:
+        timestamps, values = generate_series(size, interval=60, trend=.5, noise=2., gap_ratio=.02, jitter=2,
+                                             end=1600000000, seed=size)
+        since = int(timestamps[-size // 10])
+        series_name = f'series-{size}'
+        data.add(series_name, timestamps, values)
+
+        def ffe_forecast(ts=timestamps, vals=values):
+            FastFourierExtrapolationModel('bench', _dataset(ts, vals), {}).do_forecast()
+
+        def ffe_anomalies(ts=timestamps, vals=values, since=since):
+            FastFourierExtrapolationModel('bench', _dataset(ts, vals), {}).find_anomalies(since)
+
+        # The stationarity test of a series is memoized, clear it so every run tests again
+        def analysis(ts=timestamps, vals=values, name=series_name):
+            stationarity._results.clear()
+            asyncio.run(basic_series_analysis(name, ts, vals))
+
+        def job_base_analysis(name=series_name):
+            stationarity._results.clear()
+            _run_job(siridb, _job(JOB_TYPE_BASE_SERIES_ANALYSIS, name))
+
+        def static_rules(ts=timestamps, vals=values):
+            check_static_rules(ts, vals, STATIC_RULES, now=int(ts[-1]))
+
+        cases += [
+            (f'ffe_forecast[{size}]', size, ffe_forecast),
+            (f'ffe_anomalies[{size}]', size, ffe_anomalies),
+            (f'basic_series_analysis[{size}]', size, analysis),
+            (f'static_rules[{size}]', size, static_rules),
+            (f'job_forecast_ffe[{size}]', size,
+             lambda name=series_name: _run_job(siridb, _job(JOB_TYPE_FORECAST_SERIES, name))),
+            (f'job_anomalies_ffe[{size}]', size,
+             lambda name=series_name, since=since: _run_job(
+                 siridb, _job(JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, name, points_since=since))),
+            (f'job_base_analysis[{size}]', size, job_base_analysis),
+            (f'job_static_rules[{size}]', size,
+             lambda name=series_name: _run_job(siridb, _job(JOB_TYPE_STATIC_RULES, name))),
+        ]
+        if size > MAX_FIT_SIZE:
+            continue
+
+        def prophet(ts=timestamps, vals=values):
+            model = ProphetModel('bench', _dataset(ts, vals))
+            model.create_model()
+            model.do_forecast()
+
+        def autoregression(ts=timestamps, vals=values):
+            model = AutoRegressionModel('bench', _dataset(ts, vals))
+            model.create_model()
+            model.do_forecast()
+
+        cases += [
+            (f'prophet_forecast[{size}]', size, prophet),
+            (f'ar_forecast[{size}]', size, autoregression),
+            (f'job_forecast_prophet[{size}]', size,
+             lambda name=series_name: _run_job(siridb, _job(JOB_TYPE_FORECAST_SERIES, name, model='prophet'))),
+        ]
+    return cases
+
+
+def analyser_settings():
+    """Analyser settings with the defaults of the config, except for the
+    model cache which is disabled so every run fits its model
+    """
+    defaults = EMPTY_CONFIG_FILE['analyser']
+    return {
+        'model_cache': {'max_models': 0, 'reuse_ratio': 0},
+        'prophet': {
+            'max_warm_refits': int(defaults['prophet_max_warm_refits']),
+            'warm_start_ratio': float(defaults['prophet_warm_start_ratio']),
+            'refit_window': int(defaults['prophet_refit_window']),
+        },
+        'resolution': {
+            'prophet_max_points': int(defaults['prophet_max_points']),
+            'ffe_max_points': int(defaults['ffe_max_points']),
+        },
+        'incremental': {
+            'max_new_ratio': float(defaults['incremental_max_new_ratio']),
+            'max_age': int(defaults['incremental_max_age']),
+        },
+    }
+
+
+def run_case(func, repeat, max_seconds):
+    """Time a case at least once and at most repeat times, stops repeating
+    when the case took max_seconds in total
+    """
+    timings = []
+    while len(timings) < repeat and sum(timings) < max_seconds:
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def compare(results, baseline, tolerance):
+    """Returns the cases with a median more than tolerance slower than the baseline"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None or 'median' not in base or 'median' not in result:
+            continue
+        ratio = result['median'] / base['median'] if base['median'] else 1.
+        if ratio > 1 + tolerance:
+            regressions.append((name, base['median'], result['median'], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the models and job pipeline of the worker')
+    parser.add_argument('--quick', action='store_true', help='only benchmark small series')
+    parser.add_argument('--repeat', type=int, default=5, help='maximum number of runs per case')
+    parser.add_argument('--max-seconds', type=float, default=10., help='stop repeating a case after this time')
+    parser.add_argument('--filter', default='', help='only run cases containing this text')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=.25, help='allowed slow down compared to the baseline')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    warnings.simplefilter('ignore')
+    setup_analyser(analyser_settings())
+
+    results = {}
+    for name, num_points, func in build_cases(QUICK_SIZES if args.quick else SIZES):
+        if args.filter not in name:
+            continue
+        try:
+            timings = run_case(func, args.repeat, args.max_seconds)
+        except Exception as e:
+            results[name] = {'points': num_points, 'error': str(e)}
+            print(f'{name:40} error: {str(e)}')
+            continue
+        results[name] = {
+            'points': num_points,
+            'runs': len(timings),
+            'min': min(timings),
+            'median': statistics.median(timings),
+        }
+        print(f'{name:40} median {results[name]["median"] * 1000:10.2f} ms  min {results[name]["min"] * 1000:10.2f} ms')
+
+    output = {
+        'created': int(time.time()),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(output, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, base, current, ratio in regressions:
+            print(f'REGRESSION {name}: {base * 1000:.2f} ms -> {current * 1000:.2f} ms ({ratio:.2f}x)')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
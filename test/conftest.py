@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Tests import the worker modules (lib) and the helpers next to them (synthetic)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,227 @@
+"""Enodo hub stand-in handing out jobs to workers"""
+import asyncio
+import collections
+import logging
+import time
+
+import qpack
+
+from enodo.protocol.package import PACKET_HEADER_LEN, HANDSHAKE, HANDSHAKE_OK, HEARTBEAT, CLIENT_SHUTDOWN, \
+    WORKER_JOB, WORKER_JOB_RESULT, WORKER_JOB_CANCEL, WORKER_JOB_CANCELLED, WORKER_UPDATE_BUSY, WORKER_REFUSED, \
+    create_header, read_header
+from enodo.protocol.packagedata import EnodoJobRequestDataModel
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+STATUS_CANCELLED = 'cancelled'
+STATUS_LOST = 'lost'
+
+
+class HubJob:
+    """A job and the moments it was submitted, dispatched and finished"""
+
+    __slots__ = ('job_id', 'job_data', 'submitted_at', 'dispatched_at', 'finished_at', 'status', 'result',
+                 'worker', 'future')
+
+    def __init__(self, job_id, job_data, future):
+        self.job_id = job_id
+        self.job_data = job_data
+        self.submitted_at = time.perf_counter()
+        self.dispatched_at = None
+        self.finished_at = None
+        self.status = None
+        self.result = None
+        self.worker = None
+        self.future = future
+
+    @property
+    def latency(self):
+        """Time between submitting the job and its result"""
+        return self.finished_at - self.submitted_at
+
+    @property
+    def service_time(self):
+        """Time between handing the job to a worker and its result"""
+        return self.finished_at - self.dispatched_at
+
+
+class _WorkerConnection:
+
+    def __init__(self, writer, task):
+        self.writer = writer
+        self.task = task
+        self.client_id = None
+        self.max_concurrent_jobs = 0
+        self.busy = False
+        self.jobs = {}
+        self.last_dispatched = None
+        self.heartbeats = 0
+        self._packet_id = 0
+
+    @property
+    def free_slots(self):
+        return max(self.max_concurrent_jobs - len(self.jobs), 0)
+
+    def send(self, packet_type, data=None):
+        body = b'' if data is None else qpack.packb(data)
+        self.writer.write(create_header(len(body), packet_type, self._packet_id) + body)
+        self._packet_id = (self._packet_id + 1) % 256
+
+
+class FakeHub:
+    """Hub speaking the enodo protocol on the running event loop
+
+    Submitted jobs are queued and handed to connected workers while they
+    have free slots. Every job resolves its future with the HubJob when the
+    worker sends a result or confirms cancelling the job.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, token=''):
+        self.host = host
+        self.port = port
+        self._token = token
+        self._server = None
+        self._workers = []
+        self._pending = collections.deque()
+        self._jobs = {}
+        self._next_job_id = 1
+        self._worker_connected = None
+        self.refused = 0
+        self.busy_updates = 0
+
+    async def start(self):
+        """Start serving, returns the port listened on"""
+        self._worker_connected = asyncio.Event()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f'Fake hub listening on {self.host}:{self.port}')
+        return self.port
+
+    async def wait_for_worker(self, timeout=None):
+        await asyncio.wait_for(self._worker_connected.wait(), timeout)
+
+    async def close(self):
+        for job in list(self._jobs.values()):
+            self._finish(job, STATUS_LOST)
+        if self._server is not None:
+            self._server.close()
+        workers = list(self._workers)
+        for worker in workers:
+            worker.writer.close()
+        await asyncio.gather(*(worker.task for worker in workers), return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    @property
+    def workers(self):
+        return [worker for worker in self._workers if worker.client_id is not None]
+
+    def submit(self, job_type, series_name, series_config, **job_data):
+        """Queue a job, returns a future resolved with the finished HubJob"""
+        job_id = self._next_job_id
+        self._next_job_id += 1
+        job_data = EnodoJobRequestDataModel(
+            job_id=job_id, job_type=job_type, series_name=series_name, series_config=series_config,
+            global_series_config={}, **job_data)
+        job = HubJob(job_id, job_data, asyncio.get_event_loop().create_future())
+        self._jobs[job_id] = job
+        self._pending.append(job)
+        self._dispatch()
+        return job.future
+
+    def cancel(self, job_id):
+        """Cancel a job, queued jobs are cancelled without involving a worker"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        if job.worker is None:
+            self._pending.remove(job)
+            self._finish(job, STATUS_CANCELLED)
+        else:
+            job.worker.send(WORKER_JOB_CANCEL, {'job_id': job_id})
+
+    def _dispatch(self):
+        for worker in self.workers:
+            while self._pending and worker.free_slots and not worker.busy:
+                job = self._pending.popleft()
+                job.worker = worker
+                job.dispatched_at = time.perf_counter()
+                worker.jobs[job.job_id] = job
+                worker.last_dispatched = job
+                worker.send(WORKER_JOB, job.job_data.serialize())
+                # The worker reports busy after accepting the job when it has no slots left
+                if not worker.free_slots:
+                    worker.busy = True
+
+    def _finish(self, job, status, result=None):
+        self._jobs.pop(job.job_id, None)
+        if job.worker is not None:
+            job.worker.jobs.pop(job.job_id, None)
+        job.finished_at = time.perf_counter()
+        job.status = status
+        job.result = result
+        if not job.future.done():
+            job.future.set_result(job)
+
+    def _requeue(self, job):
+        job.worker.jobs.pop(job.job_id, None)
+        job.worker = None
+        job.dispatched_at = None
+        self._pending.appendleft(job)
+
+    def _on_packet(self, worker, packet_type, data):
+        if packet_type == HANDSHAKE:
+            if self._token and data.get('token') != self._token:
+                logging.warning(f'Worker {data.get("client_id")} sent an invalid token')
+            worker.client_id = data.get('client_id')
+            worker.max_concurrent_jobs = int(data.get('max_concurrent_jobs') or 1)
+            worker.busy = bool(data.get('busy'))
+            worker.send(HANDSHAKE_OK)
+            self._worker_connected.set()
+        elif packet_type == HEARTBEAT:
+            worker.heartbeats += 1
+            worker.send(HEARTBEAT)
+        elif packet_type == WORKER_UPDATE_BUSY:
+            self.busy_updates += 1
+            worker.busy = bool(data)
+        elif packet_type == WORKER_JOB_RESULT:
+            job = worker.jobs.get(data.get('job_id'))
+            if job is None:
+                logging.warning(f'Result for unknown job {data.get("job_id")}')
+            else:
+                self._finish(job, STATUS_ERROR if 'error' in data else STATUS_OK, data)
+        elif packet_type == WORKER_JOB_CANCELLED:
+            job = worker.jobs.get(data.get('job_id'))
+            if job is not None:
+                self._finish(job, STATUS_CANCELLED)
+        elif packet_type == WORKER_REFUSED:
+            # A refusal carries no job id, the worker answers a job with it
+            # directly, so it concerns the job handed out last
+            self.refused += 1
+            worker.busy = True
+            if worker.last_dispatched is not None and worker.last_dispatched.job_id in worker.jobs:
+                self._requeue(worker.last_dispatched)
+        elif packet_type == CLIENT_SHUTDOWN:
+            logging.info(f'Worker {worker.client_id} is shutting down')
+        else:
+            logging.warning(f'Unexpected packet type from worker: {packet_type}')
+        self._dispatch()
+
+    async def _handle_connection(self, reader, writer):
+        worker = _WorkerConnection(writer, asyncio.current_task())
+        self._workers.append(worker)
+        try:
+            while True:
+                header = await reader.readexactly(PACKET_HEADER_LEN)
+                body_size, packet_type, _ = read_header(header)
+                body = await reader.readexactly(body_size)
+                self._on_packet(worker, packet_type, qpack.unpackb(body, decode='utf-8') if body_size else None)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._workers.remove(worker)
+            for job in list(worker.jobs.values()):
+                self._finish(job, STATUS_LOST)
+            writer.close()
+            logging.info(f'Worker {worker.client_id} disconnected')
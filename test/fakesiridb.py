@@ -0,0 +1,102 @@
+"""SiriDB server stand-in answering queries from synthetic data"""
+import asyncio
+import logging
+import threading
+
+import qpack
+
+from lib.siridb.package import Package
+
+# Request and response types of the SiriDB client protocol
+CPROTO_REQ_QUERY = 0
+CPROTO_REQ_AUTH = 2
+CPROTO_REQ_PING = 3
+CPROTO_RES_QUERY = 0
+CPROTO_RES_AUTH_SUCCESS = 2
+CPROTO_RES_ACK = 3
+CPROTO_ERR_MSG = 64
+CPROTO_ERR_QUERY = 65
+
+
+class _FakeSiriDBProtocol(asyncio.Protocol):
+
+    def __init__(self, server):
+        self._server = server
+        self._buffered_data = bytearray()
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def data_received(self, data):
+        self._buffered_data.extend(data)
+        header_size = Package.struct_datapackage.size
+        while len(self._buffered_data) >= header_size:
+            length, pid, tipe, _ = Package.struct_datapackage.unpack_from(self._buffered_data)
+            if len(self._buffered_data) < header_size + length:
+                return
+            body = bytes(self._buffered_data[header_size:header_size + length])
+            del self._buffered_data[:header_size + length]
+            self._handle(pid, tipe, qpack.unpackb(body, decode='utf-8') if length else None)
+
+    def _send(self, pid, tipe, data=None):
+        body = b'' if data is None else qpack.packb(data)
+        self._transport.write(Package.struct_datapackage.pack(len(body), pid, tipe, tipe ^ 255) + body)
+
+    def _handle(self, pid, tipe, data):
+        if tipe == CPROTO_REQ_AUTH:
+            self._send(pid, CPROTO_RES_AUTH_SUCCESS)
+        elif tipe == CPROTO_REQ_PING:
+            self._send(pid, CPROTO_RES_ACK)
+        elif tipe == CPROTO_REQ_QUERY:
+            self._server.queries += 1
+            try:
+                result = self._server.data.query(data[0])
+            except ValueError as e:
+                self._send(pid, CPROTO_ERR_QUERY, {'error_msg': str(e)})
+            else:
+                self._send(pid, CPROTO_RES_QUERY, result)
+        else:
+            self._send(pid, CPROTO_ERR_MSG, {'error_msg': f'Unsupported package type: {tipe}'})
+
+
+class FakeSiriDBServer:
+    """SiriDB server speaking the client protocol on its own thread, so
+    answering queries does not delay the caller's event loop. Every user
+    is authenticated and queries are answered by SyntheticData.
+    """
+
+    def __init__(self, data, host='127.0.0.1', port=0):
+        self.data = data
+        self.host = host
+        self.port = port
+        self.queries = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Start serving, returns the port listened on"""
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+        logging.info(f'Fake SiriDB listening on {self.host}:{self.port}')
+        return self.port
+
+    def _serve(self, started):
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(self._loop.create_server(
+            lambda: _FakeSiriDBProtocol(self), self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        started.set()
+        self._loop.run_forever()
+
+    def close(self):
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
@@ -0,0 +1,228 @@
+"""End to end load test of a worker against a fake hub and SiriDB
+
+Usage:
+    python test/loadtest.py [--jobs 1000] [--rate 50] [--mix forecast_ffe=1,static_rules=1] [--output results.json]
+
+A worker is started with main.py, connected to an in-process hub and SiriDB
+stand-in serving synthetic series. Jobs arrive at the given rate (open
+loop, 0 submits all at once) and the job latency percentiles and throughput
+are reported. With --worker-command "" a worker started elsewhere can
+connect instead, using the printed hub and SiriDB ports.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from enodo.jobs import JOB_TYPE_FORECAST_SERIES, JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, \
+    JOB_TYPE_BASE_SERIES_ANALYSIS, JOB_TYPE_STATIC_RULES
+
+from fakehub import FakeHub, STATUS_OK, STATUS_ERROR, STATUS_CANCELLED, STATUS_LOST
+from fakesiridb import FakeSiriDBServer
+from synthetic import generate_series, SyntheticData
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATIC_RULES = {'min': 0, 'max': 200, 'max_rate': 1, 'flatline_points': 10, 'max_gap': 600, 'last_n_points': 1000}
+
+# Job kinds of the mix: job type and model
+JOB_KINDS = {
+    'forecast_ffe': (JOB_TYPE_FORECAST_SERIES, 'ffe'),
+    'forecast_prophet': (JOB_TYPE_FORECAST_SERIES, 'prophet'),
+    'anomalies_ffe': (JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, 'ffe'),
+    'anomalies_prophet': (JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, 'prophet'),
+    'base_analysis': (JOB_TYPE_BASE_SERIES_ANALYSIS, 'prophet'),
+    'static_rules': (JOB_TYPE_STATIC_RULES, 'static_rule_engine'),
+}
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def parse_mix(mix):
+    """Parse "kind=weight,..." into a list of kinds and a list of weights"""
+    kinds, weights = [], []
+    for item in mix.split(','):
+        kind, _, weight = item.strip().partition('=')
+        if kind not in JOB_KINDS:
+            raise ValueError(f'Unknown job kind "{kind}", choose from {", ".join(JOB_KINDS)}')
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def series_config(job_type, model, points_since):
+    return {
+        'model_params': {'points_since': points_since},
+        'job_config': {job_type: {'model': model, 'model_params': {}}},
+        JOB_TYPE_BASE_SERIES_ANALYSIS: {'model_params': {'static_rules': STATIC_RULES}},
+    }
+
+
+def start_worker(command, hub_port, siridb_port, args, cwd):
+    env = dict(os.environ,
+               HUB_HOSTNAME='127.0.0.1', HUB_PORT=str(hub_port), INTERNAL_SECURITY_TOKEN='loadtest',
+               HOST='127.0.0.1', PORT=str(siridb_port), USER='loadtest', PASSWORD='loadtest',
+               DATABASE='synthetic', MAX_CONCURRENT_JOBS=str(args.concurrency), EXECUTOR=args.executor,
+               MAX_JOB_DURATION=str(args.max_job_duration), HEARTBEAT_INTERVAL='5')
+    return subprocess.Popen(shlex.split(command), cwd=cwd, env=env)
+
+
+def summarize(values):
+    if not len(values):
+        return None
+    summary = {f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES}
+    summary['mean'] = float(np.mean(values))
+    summary['max'] = float(np.max(values))
+    return summary
+
+
+def report(jobs, elapsed, hub):
+    """Latency percentiles and throughput per job kind and in total"""
+    statuses = [STATUS_OK, STATUS_ERROR, STATUS_CANCELLED, STATUS_LOST]
+    kinds = {}
+    for kind, job in jobs:
+        kinds.setdefault(kind, []).append(job)
+    kinds['total'] = [job for _, job in jobs]
+
+    results = {}
+    for kind, kind_jobs in kinds.items():
+        finished = [job for job in kind_jobs if job.status in (STATUS_OK, STATUS_ERROR)]
+        results[kind] = {
+            'jobs': len(kind_jobs),
+            **{status: sum(job.status == status for job in kind_jobs) for status in statuses},
+            'throughput': len(finished) / elapsed if elapsed else 0.,
+            'latency': summarize([job.latency for job in finished]),
+            'service_time': summarize([job.service_time for job in finished]),
+        }
+    return {
+        'elapsed': elapsed,
+        'refused': hub.refused,
+        'busy_updates': hub.busy_updates,
+        'results': results,
+    }
+
+
+def print_report(output):
+    print(f'elapsed {output["elapsed"]:.1f}s, refused {output["refused"]}')
+    header = f'{"kind":20} {"jobs":>6} {"ok":>6} {"error":>6} {"cancel":>6} {"lost":>6} {"jobs/s":>8}'
+    header += ''.join(f' {f"p{p} ms":>10}' for p in PERCENTILES) + f' {"max ms":>10}'
+    print(header)
+    for kind, result in output['results'].items():
+        line = f'{kind:20} {result["jobs"]:6} {result[STATUS_OK]:6} {result[STATUS_ERROR]:6} ' \
+               f'{result[STATUS_CANCELLED]:6} {result[STATUS_LOST]:6} {result["throughput"]:8.2f}'
+        latency = result['latency']
+        if latency is not None:
+            line += ''.join(f' {latency[f"p{p}"] * 1000:10.1f}' for p in PERCENTILES)
+            line += f' {latency["max"] * 1000:10.1f}'
+        print(line)
+
+
+async def run(args):
+    data = SyntheticData()
+    now = int(time.time())
+    series_names = []
+    for i in range(args.series):
+        timestamps, values = generate_series(args.points, interval=args.interval, trend=.5, noise=2.,
+                                             gap_ratio=.01, jitter=2, end=now, seed=i)
+        series_names.append(f'loadtest-{i}')
+        data.add(series_names[-1], timestamps, values)
+    points_since = now - args.points * args.interval // 10
+
+    siridb_server = FakeSiriDBServer(data, port=args.siridb_port)
+    hub = FakeHub(port=args.hub_port, token='loadtest')
+    siridb_port = siridb_server.start()
+    hub_port = await hub.start()
+    print(f'hub on port {hub_port}, SiriDB on port {siridb_port}')
+
+    worker = None
+    # The worker writes its identity file to the working directory
+    worker_dir = tempfile.TemporaryDirectory()
+    try:
+        if args.worker_command:
+            worker = start_worker(args.worker_command, hub_port, siridb_port, args, worker_dir.name)
+        await hub.wait_for_worker(args.connect_timeout)
+
+        kinds, weights = parse_mix(args.mix)
+        rng = random.Random(args.seed)
+        jobs = []
+        start = time.perf_counter()
+        for i in range(args.jobs):
+            if args.rate:
+                delay = start + i / args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            kind = rng.choices(kinds, weights)[0]
+            job_type, model = JOB_KINDS[kind]
+            future = hub.submit(job_type, rng.choice(series_names), series_config(job_type, model, points_since),
+                                model_name=model)
+            jobs.append((kind, future))
+            if args.cancel_ratio and rng.random() < args.cancel_ratio:
+                asyncio.get_event_loop().call_later(
+                    rng.uniform(0, args.cancel_delay), hub.cancel, i + 1)
+
+        futures = [future for _, future in jobs]
+        await asyncio.wait(futures, timeout=args.drain_timeout)
+        elapsed = time.perf_counter() - start
+    finally:
+        await hub.close()
+        siridb_server.close()
+        if worker is not None:
+            worker.terminate()
+            try:
+                worker.wait(10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        worker_dir.cleanup()
+
+    output = report([(kind, future.result()) for kind, future in jobs], elapsed, hub)
+    output['siridb_queries'] = siridb_server.queries
+    output['settings'] = vars(args)
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a worker against a fake hub and SiriDB')
+    parser.add_argument('--jobs', type=int, default=1000, help='number of jobs to submit')
+    parser.add_argument('--rate', type=float, default=50., help='jobs submitted per second, 0 for all at once')
+    parser.add_argument('--mix', default='forecast_ffe=1,anomalies_ffe=1,static_rules=2,base_analysis=1',
+                        help=f'job kinds and their weights, kinds: {", ".join(JOB_KINDS)}')
+    parser.add_argument('--series', type=int, default=100, help='number of synthetic series')
+    parser.add_argument('--points', type=int, default=5000, help='points per series')
+    parser.add_argument('--interval', type=int, default=60, help='seconds between points')
+    parser.add_argument('--cancel-ratio', type=float, default=0., help='fraction of the jobs cancelled by the hub')
+    parser.add_argument('--cancel-delay', type=float, default=1., help='maximum seconds before cancelling a job')
+    parser.add_argument('--concurrency', type=int, default=4, help='max_concurrent_jobs of the worker')
+    parser.add_argument('--executor', default='thread', help='executor of the worker, thread or process')
+    parser.add_argument('--max-job-duration', type=int, default=120, help='max_job_duration of the worker')
+    parser.add_argument('--worker-command', default=f'{sys.executable} {os.path.join(ROOT, "main.py")} --log_level error',
+                        help='command starting the worker, empty to wait for a worker started elsewhere')
+    parser.add_argument('--hub-port', type=int, default=0, help='port of the hub, 0 for any free port')
+    parser.add_argument('--siridb-port', type=int, default=0, help='port of SiriDB, 0 for any free port')
+    parser.add_argument('--connect-timeout', type=float, default=60., help='seconds to wait for the worker')
+    parser.add_argument('--drain-timeout', type=float, default=600.,
+                        help='seconds to wait for outstanding jobs, unfinished jobs are reported as lost')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the job mix')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    output = asyncio.run(run(args))
+    print_report(output)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(output, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
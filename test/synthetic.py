@@ -0,0 +1,150 @@
+"""Synthetic series and a SiriDB stand-in for benchmarks and load tests"""
+import re
+import time
+
+import numpy as np
+
+from lib.siridb.siridb import SiriDB
+
+
+def generate_series(length, interval=60, season=86400, amplitude=10., trend=0., noise=1., gap_ratio=0.,
+                    jitter=0, end=None, seed=0):
+    """
+    Generate a series with a daily (or other) season, trend, noise and gaps
+    :param length: number of points before gaps are removed
+    :param interval: seconds between points
+    :param season: seasonality period in seconds, 0 for none
+    :param amplitude: amplitude of the season
+    :param trend: increase of the values per day
+    :param noise: standard deviation of the noise
+    :param gap_ratio: fraction of the points removed in gaps of up to 100 points
+    :param jitter: maximum deviation in seconds of the timestamps
+    :param end: timestamp of the last point, defaults to now
+    :param seed: seed of the random generator
+    :return: tuple with int64 timestamps and float64 values
+    """
+    rng = np.random.default_rng(seed)
+    end = int(time.time()) if end is None else int(end)
+    timestamps = end - interval * np.arange(length - 1, -1, -1, dtype=np.int64)
+    if jitter:
+        timestamps[:-1] += rng.integers(-jitter, jitter + 1, length - 1)
+        timestamps = np.unique(timestamps)
+    values = 100. + trend * (timestamps - timestamps[0]) / 86400
+    if season:
+        values += amplitude * np.sin(2 * np.pi * timestamps / season)
+    values += rng.normal(0, noise, len(timestamps))
+
+    if gap_ratio:
+        keep = np.ones(len(timestamps), dtype=bool)
+        to_remove = int(len(timestamps) * gap_ratio)
+        while to_remove > 0:
+            size = min(int(rng.integers(1, 101)), to_remove)
+            start = int(rng.integers(0, max(len(timestamps) - size - 1, 1)))
+            to_remove -= int(keep[start:start + size].sum())
+            keep[start:start + size] = False
+        keep[-1] = True
+        timestamps, values = timestamps[keep], values[keep]
+    return timestamps, values
+
+
+class SyntheticData:
+    """Answers the SiriDB queries made by the worker from in-memory series"""
+
+    _SELECT = re.compile(r'^select (?P<selector>.+?) from (?P<series>.+?)'
+                         r'(?: after (?P<after>.+?)| between (?P<start>\d+) and (?P<end>\d+))?$')
+
+    def __init__(self, series=None, dbname='synthetic'):
+        self.series = dict(series or {})
+        self.dbname = dbname
+
+    def add(self, series_name, timestamps, values):
+        self.series[series_name] = np.asarray(timestamps, dtype=np.int64), np.asarray(values, dtype=np.float64)
+
+    @staticmethod
+    def _parse_time(expression):
+        expression = expression.strip()
+        match = re.match(r'^now\s*-\s*(\d+)s$', expression)
+        if match:
+            return int(time.time()) - int(match.group(1))
+        return int(expression)
+
+    def _series_names(self, selector):
+        selector = selector.strip()
+        if selector.startswith('/') and selector.endswith('/'):
+            pattern = re.compile(selector[1:-1])
+            return [name for name in self.series if pattern.search(name)]
+        names = [name.strip().strip('"') for name in selector.split(',')]
+        return [name for name in names if name in self.series]
+
+    @staticmethod
+    def _to_points(timestamps, values):
+        return [[ts, value] for ts, value in zip(timestamps.tolist(), values.tolist())]
+
+    def _select(self, selector, timestamps, values):
+        if selector == '*':
+            return {'': self._to_points(timestamps, values)}
+        match = re.match(r'^mean\((\d+)s\)$', selector)
+        if match:
+            interval = int(match.group(1))
+            buckets = -(-timestamps // interval)
+            starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1]))) \
+                if len(buckets) else np.empty(0, dtype=np.int64)
+            if not len(starts):
+                return {'': []}
+            means = np.add.reduceat(values, starts) / np.diff(np.append(starts, len(values)))
+            return {'': self._to_points(buckets[starts] * interval, means)}
+        result = {}
+        for function in selector.split(','):
+            match = re.match(r'^\s*(count|first|last)\(\)(?:\s+prefix\s+"(.*)")?\s*$', function)
+            if match is None:
+                raise ValueError(f'Unsupported selector: {selector}')
+            name, prefix = match.group(1), match.group(2) or ''
+            if not len(timestamps):
+                continue
+            if name == 'count':
+                result[prefix] = [[int(timestamps[-1]), len(timestamps)]]
+            else:
+                i = 0 if name == 'first' else -1
+                result[prefix] = [[int(timestamps[i]), float(values[i])]]
+        return result
+
+    def query(self, query):
+        query = query.strip()
+        if query == 'show dbname':
+            return {'data': [{'name': 'dbname', 'value': self.dbname}]}
+        match = self._SELECT.match(query)
+        if match is None:
+            raise ValueError(f'Unsupported query: {query}')
+        result = {}
+        for series_name in self._series_names(match.group('series')):
+            timestamps, values = self.series[series_name]
+            if match.group('after') is not None:
+                # Like SiriDB, the start bound of after is inclusive
+                keep = timestamps >= self._parse_time(match.group('after'))
+                timestamps, values = timestamps[keep], values[keep]
+            elif match.group('start') is not None:
+                keep = (timestamps >= int(match.group('start'))) & (timestamps < int(match.group('end')))
+                timestamps, values = timestamps[keep], values[keep]
+            for prefix, points in self._select(match.group('selector').strip(), timestamps, values).items():
+                result[prefix + series_name] = points
+        return result
+
+
+class FakeSiriDB(SiriDB):
+    """SiriDB connection answering queries from synthetic data in-process,
+    so the complete fetch path of the worker is exercised
+    """
+
+    def __init__(self, data, series_cache=None):
+        self._data = data
+        self._series_cache = series_cache
+        self.siridb_connected = True
+
+    async def query(self, query):
+        return self._data.query(query)
+
+    async def test_connection(self):
+        return "", True
+
+    def close(self):
+        pass
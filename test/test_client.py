@@ -0,0 +1,129 @@
+import asyncio
+import socket
+
+import qpack
+from enodo.protocol.package import PACKET_HEADER_LEN, HANDSHAKE, HEARTBEAT, WORKER_JOB, create_header, read_header
+
+from lib.client import WorkerClient
+
+
+def packet(message_type, body, packet_id=1):
+    data = qpack.packb(body)
+    return create_header(len(data), message_type, packet_id) + data
+
+
+async def connected_client():
+    """WorkerClient connected to the returned socket of a socketpair"""
+    client = WorkerClient(asyncio.get_running_loop(), 'localhost', 0, 'worker', 'token')
+    client_sock, hub_sock = socket.socketpair()
+    client_sock.setblocking(False)
+    hub_sock.setblocking(False)
+    client._sock = client_sock
+    client._connected = True
+    jobs = []
+
+    async def on_job(data):
+        jobs.append(data)
+
+    client._cbs = {WORKER_JOB: on_job}
+    return client, hub_sock, jobs
+
+
+def test_packet_received_in_parts():
+    async def main():
+        client, hub_sock, jobs = await connected_client()
+        data = packet(WORKER_JOB, {'job_id': 1, 'series_name': 'series'})
+        for part in (data[:3], data[3:PACKET_HEADER_LEN + 2], data[PACKET_HEADER_LEN + 2:]):
+            assert jobs == []
+            hub_sock.send(part)
+            await client._read_available()
+        assert jobs == [{'job_id': 1, 'series_name': 'series'}]
+        assert not client._buffer
+
+    asyncio.run(main())
+
+
+def test_packets_received_at_once():
+    async def main():
+        client, hub_sock, jobs = await connected_client()
+        second = packet(WORKER_JOB, {'job_id': 2})
+        hub_sock.send(packet(WORKER_JOB, {'job_id': 1}) + packet(HEARTBEAT, None) + second[:4])
+        await client._read_available()
+        assert jobs == [{'job_id': 1}]
+        hub_sock.send(second[4:])
+        await client._read_available()
+        assert jobs == [{'job_id': 1}, {'job_id': 2}]
+
+    asyncio.run(main())
+
+
+def test_reconnect_on_lost_connection():
+    async def main():
+        client, hub_sock, jobs = await connected_client()
+        lost_sock = client._sock
+        hub = socket.create_server(('127.0.0.1', 0))
+        client._hostname, client._port = hub.getsockname()
+
+        # A partial packet is dropped with the connection it arrived on
+        hub_sock.send(packet(WORKER_JOB, {'job_id': 1})[:8])
+        await client._read_available()
+        hub_sock.close()
+        await client._read_available()
+        assert lost_sock.fileno() == -1
+        assert client._connected
+        assert not client._buffer
+
+        # The client shakes hands again on the new connection
+        conn, _ = hub.accept()
+        header = conn.recv(PACKET_HEADER_LEN)
+        assert read_header(header)[1] == HANDSHAKE
+        conn.recv(read_header(header)[0])
+        conn.sendall(packet(WORKER_JOB, {'job_id': 2}))
+        await asyncio.sleep(.1)
+        await client._read_available()
+        assert jobs == [{'job_id': 2}]
+        conn.close()
+        hub.close()
+        client._sock.close()
+
+    asyncio.run(main())
+
+
+def test_packet_id_wraps():
+    async def main():
+        client, hub_sock, _ = await connected_client()
+        client._current_message_id = 255
+        for _ in range(2):
+            await client.send_message({'job_id': 1}, WORKER_JOB)
+        await asyncio.sleep(0)
+        data = hub_sock.recv(1024)
+        first_len = PACKET_HEADER_LEN + read_header(data)[0]
+        assert read_header(data)[2] == 255
+        assert read_header(data[first_len:])[2] == 0
+
+    asyncio.run(main())
+
+
+def test_large_packet_sent_whole():
+    async def main():
+        client, hub_sock, _ = await connected_client()
+        body = {'points': list(range(200000))}
+        received = bytearray()
+
+        async def read_hub():
+            loop = asyncio.get_running_loop()
+            while True:
+                data = await loop.sock_recv(hub_sock, 65536)
+                if not data:
+                    return
+                received.extend(data)
+
+        reader = asyncio.ensure_future(read_hub())
+        await asyncio.gather(client.send_message(body, WORKER_JOB), client.send_message({'job_id': 2}, WORKER_JOB))
+        client._sock.close()
+        await reader
+        first_len = PACKET_HEADER_LEN + read_header(received)[0]
+        assert qpack.unpackb(bytes(received[PACKET_HEADER_LEN:first_len]), decode='utf-8') == body
+        assert qpack.unpackb(bytes(received[first_len + PACKET_HEADER_LEN:]), decode='utf-8') == {'job_id': 2}
+
+    asyncio.run(main())
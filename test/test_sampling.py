@@ -0,0 +1,50 @@
+import math
+import warnings
+
+import numpy as np
+
+from lib.analyser.sampling import detect_sampling_interval
+
+
+def test_regular_interval_with_jitter():
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(0, 60000, 60) + rng.integers(-2, 3, 1000)
+    interval, regularity = detect_sampling_interval(timestamps)
+    assert abs(interval - 60) < 1
+    assert regularity > .9
+
+
+def test_gaps_do_not_change_the_interval():
+    timestamps = np.concatenate((np.arange(0, 6000, 60), np.arange(100000, 106000, 60)))
+    interval, regularity = detect_sampling_interval(timestamps)
+    assert interval == 60
+    assert regularity > .98
+
+
+def test_bimodal_intervals_fall_back_to_the_median():
+    timestamps = np.cumsum(np.concatenate(([0], np.tile([10, 30], 50))))
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        interval, regularity = detect_sampling_interval(timestamps)
+    assert interval == 20
+    assert regularity == 0.
+
+
+def test_irregular_intervals_give_a_finite_interval():
+    rng = np.random.default_rng(1)
+    timestamps = np.cumsum(rng.choice([1, 7, 50, 300], 500))
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        interval, regularity = detect_sampling_interval(timestamps)
+    assert math.isfinite(interval) and interval > 0
+    assert 0. <= regularity <= 1.
+
+
+def test_datetimes_are_returned_in_nanoseconds():
+    timestamps = np.arange(0, 600, 60).astype('datetime64[s]')
+    assert detect_sampling_interval(timestamps) == (60e9, 1.)
+
+
+def test_not_enough_points():
+    assert detect_sampling_interval([5]) == (None, 0.)
+    assert detect_sampling_interval([5, 5]) == (None, 0.)
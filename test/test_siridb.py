@@ -0,0 +1,19 @@
+import numpy as np
+
+from lib.siridb.cache import SeriesCacheEntry
+from lib.siridb.siridb import group_by_watermark
+
+
+def entry(last_timestamp):
+    return SeriesCacheEntry(np.arange(last_timestamp - 600, last_timestamp + 1, 60), np.zeros(11))
+
+
+def test_close_watermarks_share_a_group():
+    entries = {'a': entry(100000), 'b': entry(101000), 'c': entry(100500)}
+    assert [(last, list(group)) for last, group in group_by_watermark(entries)] == [(100000, ['a', 'c', 'b'])]
+
+
+def test_far_apart_watermarks_are_grouped_apart():
+    entries = {'old': entry(100000), 'new': entry(500000), 'newer': entry(500100)}
+    groups = group_by_watermark(entries, span=3600)
+    assert [(last, list(group)) for last, group in groups] == [(100000, ['old']), (500000, ['new', 'newer'])]
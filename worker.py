@@ -5,19 +5,47 @@ import traceback
 import os
 import logging
 
-from queue import Queue
-from threading import Thread
+from threading import Event
 
 from version import VERSION
 from enodo import EnodoModel
-from enodo.client import Client
 from enodo.protocol.package import *
 from enodo.jobs import JOB_TYPE_FORECAST_SERIES, JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, JOB_TYPE_BASE_SERIES_ANALYSIS, JOB_TYPE_STATIC_RULES
 from enodo.protocol.packagedata import EnodoJobDataModel
 
-from lib.analyser.analyser import start_analysing
+from lib.analyser.analyser import setup_analyser
+from lib.analyser.processpool import AnalyserProcessPool
+from lib.analyser.threadpool import AnalyserThreadPool
+from lib.client import WorkerClient
 from lib.config import EnodoConfigParser
+from lib.jobs import JOB_TYPE_FORECAST_SERIES_BATCH, JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES_BATCH, \
+    JOB_TYPE_STATIC_RULES_BATCH
 from lib.logging import prepare_logger
+from lib.metrics import WorkerMetrics, start_metrics_server
+from lib.util import ThreadsafeQueue
+
+EXECUTOR_THREAD = 'thread'
+EXECUTOR_PROCESS = 'process'
+
+# Seconds between checks whether the analyser thread of a cancelled job stopped it
+STOP_POLL_INTERVAL = .1
+# Warn when a cancelled job is still running after this many seconds
+STOP_GRACE_PERIOD = 10
+
+
+class RunningJob:
+
+    __slots__ = ('job_id', 'job_type', 'model', 'done', 'cancelled', 'started_at', 'timeout_handle')
+
+    def __init__(self, job_id, job_type=None, model=None):
+        self.job_id = job_id
+        self.job_type = job_type
+        self.model = model
+        # Set by the analyser thread pool when a thread finished the job
+        self.done = None
+        self.cancelled = Event()
+        self.started_at = datetime.datetime.now()
+        self.timeout_handle = None
 
 
 class Worker:
@@ -28,30 +56,83 @@ class Worker:
         self._config = EnodoConfigParser()
         if config_path is not None and os.path.exists(config_path):
             self._config.read(config_path)
-        self._client = Client(loop,
-                                self._config['enodo']['hub_hostname'],
-                                int(self._config['enodo']['hub_port']),
-                                'worker', self._config['enodo']['internal_security_token'],
-                                heartbeat_interval=int(self._config['enodo']['heartbeat_interval']),
-                                identity_file_path=".enodo_id", client_version=VERSION)
+        self._client = WorkerClient(loop,
+                                    self._config['enodo']['hub_hostname'],
+                                    int(self._config['enodo']['hub_port']),
+                                    'worker', self._config['enodo']['internal_security_token'],
+                                    heartbeat_interval=int(self._config['enodo']['heartbeat_interval']),
+                                    identity_file_path=".enodo_id", client_version=VERSION)
 
         self._client_run_task = None
         self._updater_task = None
-        self._result_queue = Queue()
+        self._result_queue = ThreadsafeQueue(loop)
         self._busy = False
-        self._started_last_job = None
-        self._max_job_duration = self._config['enodo']['max_job_duration']
-        self._worker_thread = None
-        self._current_job = None
+        self._max_job_duration = int(self._config['enodo']['max_job_duration'])
+        self._max_concurrent_jobs = int(self._config['enodo']['max_concurrent_jobs'])
+        if self._max_concurrent_jobs < 1:
+            self._max_concurrent_jobs = os.cpu_count() or 1
+        self._executor = self._config['enodo']['executor']
+        if self._executor not in (EXECUTOR_THREAD, EXECUTOR_PROCESS):
+            raise Exception(f'Invalid config, unknown executor "{self._executor}"')
+        self._process_pool = None
+        self._thread_pool = None
+        self._analyser_settings = self._read_analyser_settings()
+        self._jobs = {}
+        # Cancelled jobs whose analyser thread or process did not stop yet, these keep their slot
+        self._stopping_jobs = {}
+        self._metrics = WorkerMetrics()
+        self._metrics_server = None
         self._running = True
-        self._current_job_started_at = None
         self._jobs_and_models = {}
 
-    async def _update_busy(self, busy, job_id=None):
-        self._busy = busy
-        self._current_job = job_id
-        self._current_job_started_at = datetime.datetime.now() if busy else None
-        await self._client.send_message(busy, WORKER_UPDATE_BUSY)
+    def _read_analyser_settings(self):
+        return {
+            'siridb': {
+                'siridb_user': self._config['siridb']['user'],
+                'siridb_password': self._config['siridb']['password'],
+                'siridb_db': self._config['siridb']['database'],
+                'siridb_host': self._config['siridb']['host'],
+                'siridb_port': self._config['siridb']['port'],
+            },
+            'series_cache': {
+                'max_points': int(self._config['siridb']['series_cache_max_points']),
+                'max_age': int(self._config['siridb']['series_cache_max_age']),
+                'store_path': self._config['siridb'].get('series_cache_path', ''),
+            },
+            'model_cache': {
+                'max_models': int(self._config['analyser']['model_cache_size']),
+                'reuse_ratio': float(self._config['analyser']['model_cache_reuse_ratio']),
+                'path': self._config['analyser'].get('model_cache_path', ''),
+            },
+            'prophet': {
+                'max_warm_refits': int(self._config['analyser']['prophet_max_warm_refits']),
+                'warm_start_ratio': float(self._config['analyser']['prophet_warm_start_ratio']),
+                'refit_window': int(self._config['analyser']['prophet_refit_window']),
+            },
+            'resolution': {
+                'prophet_max_points': int(self._config['analyser']['prophet_max_points']),
+                'ffe_max_points': int(self._config['analyser']['ffe_max_points']),
+            },
+            'incremental': {
+                'max_new_ratio': float(self._config['analyser']['incremental_max_new_ratio']),
+                'max_age': int(self._config['analyser']['incremental_max_age']),
+            },
+            'profiling': {
+                'threshold': float(self._config['analyser']['profile_threshold']),
+                'path': self._config['analyser'].get('profile_path', ''),
+            }
+        }
+
+    @property
+    def free_slots(self):
+        return max(self._max_concurrent_jobs - len(self._jobs) - len(self._stopping_jobs), 0)
+
+    async def _update_busy(self):
+        self._busy = self.free_slots == 0
+        self._metrics.running_jobs.set(len(self._jobs))
+        self._metrics.stopping_jobs.set(len(self._stopping_jobs))
+        self._metrics.free_slots.set(self.free_slots)
+        await self._client.send_message(self._busy, WORKER_UPDATE_BUSY)
 
     async def _send_refused(self):
         await self._client.send_message(None, WORKER_REFUSED)
@@ -61,21 +142,30 @@ class Worker:
 
     async def _check_for_update(self):
         while self._running:
-            if not self._result_queue.empty():
-                try:
-                    result = self._result_queue.get()
-                except Exception as e:
-                    logging.error('Error while fetching item from result queue')
-                    logging.debug(f'Correspondig error: {str(e)}')
-                else:
-                    result['job_id'] = self._current_job
-                    await self._send_update(result)
-                    await self._update_busy(False)
-            if self._busy and (
-                    datetime.datetime.now() - self._current_job_started_at).total_seconds() >= int(
-                self._max_job_duration):
-                await self._cancel_job()
-            await asyncio.sleep(2)
+            result = await self._result_queue.get()
+            job = self._pop_job(result.get('job_id'))
+            if job is None:
+                logging.debug(f'Dropping result of unknown or cancelled job: {result.get("job_id")}')
+                continue
+            duration = (datetime.datetime.now() - job.started_at).total_seconds()
+            self._metrics.observe_result(result, job.job_type, job.model, duration)
+            await self._send_update(result)
+            await self._update_busy()
+
+    def _add_job(self, job):
+        job.timeout_handle = self._loop.call_later(
+            self._max_job_duration, self._on_job_timeout, job.job_id)
+        self._jobs[job.job_id] = job
+
+    def _pop_job(self, job_id):
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            job.timeout_handle.cancel()
+        return job
+
+    def _on_job_timeout(self, job_id):
+        logging.warning(f'Job {job_id} exceeded max job duration, cancelling')
+        self._loop.create_task(self._cancel_job(job_id, reason='timeout'))
 
     async def _send_update(self, pkl):
         try:
@@ -86,48 +176,62 @@ class Worker:
 
     async def _receive_job(self, data):
         if self._busy:
+            self._metrics.jobs_refused.inc(reason='busy')
             await self._send_refused()
-        else:
-            try:
-                data = EnodoJobDataModel.unserialize(data)
-                logging.info(f'Received request for {data.get("job_type")} for series: "{data.get("series_name")}"')
-            except Exception as e:
-                logging.error('Error while unserializing incoming job data')
-                logging.debug(f'Correspondig error: {str(e)}')
-            await self._update_busy(True, data.get('job_id'))
-            worker_loop = asyncio.new_event_loop()
-            job_type = data.get('job_type')
-
-            if job_type in [JOB_TYPE_FORECAST_SERIES, JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES, JOB_TYPE_BASE_SERIES_ANALYSIS, JOB_TYPE_STATIC_RULES]:
-                model_name = data.get("model_name")
-                if not await self._check_support_job_and_model(job_type, model_name):
-                    await self._send_update(
-                    {'error': 'Unsupported model for job_type', 'job_id': data.get('job_id'), 'name': data.get("series_name")})
-                    await self._update_busy(False)
-                    return
-            else:
+            return
+        try:
+            data = EnodoJobDataModel.unserialize(data)
+            logging.info(f'Received request for {data.get("job_type")} for series: "{data.get("series_name")}"')
+        except Exception as e:
+            self._metrics.jobs_refused.inc(reason='invalid')
+            logging.error('Error while unserializing incoming job data')
+            logging.debug(f'Correspondig error: {str(e)}')
+            return
+        job_id = data.get('job_id')
+        job_type = data.get('job_type')
+        model_name = data.get("model_name")
+        self._metrics.jobs_received.inc(job_type=job_type)
+
+        if job_type in self._jobs_and_models:
+            if not await self._check_support_job_and_model(job_type, model_name):
+                self._metrics.jobs_refused.inc(reason='unsupported_model')
                 await self._send_update(
-                    {'error': 'Unsupported job_type', 'job_id': data.get('job_id'), 'name': data.get("series_name")})
-                await self._update_busy(False)
+                    {'error': 'Unsupported model for job_type', 'job_id': job_id, 'name': data.get("series_name")})
+                await self._update_busy()
                 return
+        else:
+            self._metrics.jobs_refused.inc(reason='unsupported_job_type')
+            await self._send_update(
+                {'error': 'Unsupported job_type', 'job_id': job_id, 'name': data.get("series_name")})
+            await self._update_busy()
+            return
 
+        if self._executor == EXECUTOR_PROCESS:
             try:
-                from func_timeout import StoppableThread
-                self._worker_thread = Thread(target=start_analysing, args=(
-                    worker_loop,
-                    self._result_queue,
-                    data,
-                    self._config['siridb']['user'],
-                    self._config['siridb']['password'],
-                    self._config['siridb']['database'],
-                    self._config['siridb']['host'],
-                    self._config['siridb']['port'],))
-                # Start the thread
-                # self._worker_thread.daemon = True
-                self._worker_thread.start()
+                self._add_job(RunningJob(job_id, job_type, model_name))
+                self._process_pool.submit(data)
             except Exception as e:
-                logging.error('Error while creating worker thread')
+                self._pop_job(job_id)
+                self._metrics.jobs_refused.inc(reason='start_failed')
+                logging.error('Error while submitting job to analyser pool')
                 logging.debug(f'Correspondig error: {str(e)}')
+                await self._send_update(
+                    {'error': 'Unable to start job', 'job_id': job_id, 'name': data.get("series_name")})
+            await self._update_busy()
+            return
+
+        try:
+            job = RunningJob(job_id, job_type, model_name)
+            self._add_job(job)
+            job.done = self._thread_pool.submit(data, job.cancelled)
+        except Exception as e:
+            self._pop_job(job_id)
+            self._metrics.jobs_refused.inc(reason='start_failed')
+            logging.error('Error while submitting job to analyser threads')
+            logging.debug(f'Correspondig error: {str(e)}')
+            await self._send_update(
+                {'error': 'Unable to start job', 'job_id': job_id, 'name': data.get("series_name")})
+        await self._update_busy()
 
     async def _check_support_job_and_model(self, job_type, model_name=None):
         if job_type in self._jobs_and_models.keys():
@@ -138,23 +242,62 @@ class Worker:
                     return True
         return False
 
-    async def _cancel_job(self):
+    async def _cancel_job(self, job_id, reason='hub'):
+        job = self._pop_job(job_id)
+        if job is None:
+            return
+        self._metrics.jobs_cancelled.inc(reason=reason)
         try:
-            self._worker_thread.stop(Exception, 2.0)
+            if self._process_pool is not None:
+                # Waiting for the process to exit blocks, the slot stays
+                # occupied until its replacement process is started
+                self._stopping_jobs[job_id] = job
+                self._loop.create_task(self._terminate_process(job))
+            else:
+                # Threads cannot be killed, the job stops at its next checkpoint
+                job.cancelled.set()
+                if not job.done.is_set():
+                    self._stopping_jobs[job_id] = job
+                    self._loop.create_task(self._wait_for_stopped(job))
         except Exception as e:
             logging.error('Error while trying to cancel job')
             logging.debug(f'Correspondig error: {str(e)}')
         finally:
-            await self._send_job_cancelled()
+            await self._send_job_cancelled(job_id)
+
+    async def _terminate_process(self, job):
+        """Terminate the pool process of a cancelled job without blocking the event loop"""
+        try:
+            await self._loop.run_in_executor(None, self._process_pool.cancel, job.job_id)
+        except Exception as e:
+            logging.error('Error while trying to terminate analyser process')
+            logging.debug(f'Correspondig error: {str(e)}')
+        finally:
+            self._stopping_jobs.pop(job.job_id, None)
+            await self._update_busy()
+
+    async def _wait_for_stopped(self, job):
+        """Free the slot of a cancelled job once its analyser thread stopped the job"""
+        cancelled_at = self._loop.time()
+        warned = False
+        while not job.done.is_set():
+            await asyncio.sleep(STOP_POLL_INTERVAL)
+            if not warned and self._loop.time() - cancelled_at > STOP_GRACE_PERIOD:
+                warned = True
+                logging.warning(f'Cancelled job {job.job_id} is still running, its slot stays occupied until '
+                                f'its current step finishes. Use the process executor to stop jobs immediately')
+        self._stopping_jobs.pop(job.job_id, None)
+        logging.debug(f'Cancelled job {job.job_id} stopped after {self._loop.time() - cancelled_at:.1f}s')
+        await self._update_busy()
 
     async def _receive_to_cancel_job(self, data):
         job_id = data.get('job_id')
-        if job_id is self._current_job:
-            await self._cancel_job()
+        if job_id in self._jobs:
+            await self._cancel_job(job_id)
 
-    async def _send_job_cancelled(self):
-        await self._client.send_message({"job_id": self._current_job}, WORKER_JOB_CANCELLED)
-        await self._update_busy(False)
+    async def _send_job_cancelled(self, job_id):
+        await self._client.send_message({"job_id": job_id}, WORKER_JOB_CANCELLED)
+        await self._update_busy()
 
     async def _add_handshake_data(self):
         serialized_jobs_and_models = {}
@@ -162,6 +305,8 @@ class Worker:
             serialized_jobs_and_models[job] = [EnodoModel.to_dict(model) for model in self._jobs_and_models[job]]
 
         return {'busy': self._busy,
+                'max_concurrent_jobs': self._max_concurrent_jobs,
+                'free_slots': self.free_slots,
                 'jobs_and_models': serialized_jobs_and_models}
 
     async def start_worker(self):
@@ -176,6 +321,9 @@ class Worker:
         self._jobs_and_models[JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES] = list()
         self._jobs_and_models[JOB_TYPE_BASE_SERIES_ANALYSIS] = list()
         self._jobs_and_models[JOB_TYPE_STATIC_RULES] = list()
+        self._jobs_and_models[JOB_TYPE_FORECAST_SERIES_BATCH] = list()
+        self._jobs_and_models[JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES_BATCH] = list()
+        self._jobs_and_models[JOB_TYPE_STATIC_RULES_BATCH] = list()
 
         #insert models per job
         self._jobs_and_models[JOB_TYPE_BASE_SERIES_ANALYSIS].append(prophet_model)
@@ -188,15 +336,55 @@ class Worker:
 
         self._jobs_and_models[JOB_TYPE_STATIC_RULES].append(static_rule_engine)
 
+        self._jobs_and_models[JOB_TYPE_FORECAST_SERIES_BATCH].append(ffe_model)
+        self._jobs_and_models[JOB_TYPE_DETECT_ANOMALIES_FOR_SERIES_BATCH].append(ffe_model)
+        self._jobs_and_models[JOB_TYPE_STATIC_RULES_BATCH].append(static_rule_engine)
+
+        if self._executor == EXECUTOR_THREAD:
+            setup_analyser(self._analyser_settings)
+            self._thread_pool = AnalyserThreadPool(
+                self._max_concurrent_jobs,
+                self._result_queue,
+                self._analyser_settings)
+            self._thread_pool.start()
+        else:
+            self._process_pool = AnalyserProcessPool(
+                self._max_concurrent_jobs,
+                self._result_queue,
+                self._analyser_settings)
+            self._process_pool.start()
+
         await self._client.setup(cbs={
             WORKER_JOB: self._receive_job,
             WORKER_JOB_CANCEL: self._receive_to_cancel_job
         },
             handshake_cb=self._add_handshake_data)
+        metrics_port = int(self._config['enodo']['metrics_port'])
+        if metrics_port:
+            try:
+                self._metrics_server = await start_metrics_server(
+                    self._metrics, self._config['enodo']['metrics_host'], metrics_port)
+            except OSError as e:
+                logging.error('Error while starting metrics endpoint')
+                logging.debug(f'Correspondig error: {str(e)}')
+
         self._client_run_task = self._loop.create_task(self._client.run())
         self._updater_task = self._loop.create_task(self._check_for_update())
 
     async def shutdown(self):
         self._running = False
+        for job in self._jobs.values():
+            job.cancelled.set()
         await self._send_shutdown()
         await self._client.close()
+        tasks = [task for task in (self._client_run_task, self._updater_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Closing the pools waits for their threads and processes to stop
+        if self._process_pool is not None:
+            await self._loop.run_in_executor(None, self._process_pool.close)
+        if self._thread_pool is not None:
+            await self._loop.run_in_executor(None, self._thread_pool.close)
+        if self._metrics_server is not None:
+            self._metrics_server.close()